@@ -0,0 +1,753 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Benchmark collect.py against made up AWS data.
+
+The calls to AWS in collect.py are swapped for fixtures generated at the
+scale asked for, so everything after the call, the cache, the memo and the
+collectors, runs for real. The first main() run fills an empty cache in a
+temporary directory, then each collector, main() and write_csv are timed
+against the cached results.
+
+    python bench.py                               # full scale
+    python bench.py --scale 0.1                   # a tenth of everything
+    python bench.py --save-baseline bench.json    # keep the results to compare against
+    python bench.py --baseline bench.json         # exit 1 if slower or the output changed
+'''
+
+import argparse
+import json
+import logging
+import os
+import platform
+import shlex
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from hashlib import sha1
+
+import collect
+
+logger = logging.getLogger('main')
+
+# Bump when the results format changes so old baselines are not compared
+bench_version = 1
+
+# Account id of the fixtures, so collect.py never asks STS
+ACCOUNT = '123456789012'
+
+# Records per page, as AWS returns them
+DNS_PAGE_SIZE = 300
+EC2_PAGE_SIZE = 1000
+
+# Instances per EC2 reservation
+RESERVATION_SIZE = 2
+
+# Targets of DNS records that point outside AWS
+EXTERNAL_NAMES = [
+    'go.pardot.com',
+    'bench.zendesk.com',
+    '_a1b2c3.acm-validations.aws',
+    'ghs.google.com',
+    'bench.azurewebsites.net',
+    'bench.example.org',
+]
+
+# Differences from the baseline smaller than these are noise
+NOISE_SECONDS = 0.05
+NOISE_MB = 1.0
+
+
+class Fixtures:
+    '''
+    Made up AWS records for a number of zones, records per zone, instances,
+    target groups and buckets. The other resources are sized from those.
+    Resources are numbered across all regions and spread over them in turn,
+    so the same scale always gives the same records.
+    '''
+
+    def __init__(self, regions, zones=1000, records=500, instances=20000, target_groups=2000, buckets=5000):
+        self.regions = list(regions)
+        self.zones = zones
+        self.records = records
+        self.instances = instances
+        self.target_groups = target_groups
+        self.buckets = buckets
+        self.load_balancers = max(1, target_groups // 4)
+        self.classic_elbs = max(1, self.load_balancers // 10)
+        self.asgs = max(1, target_groups // 10)
+        self.distributions = max(1, buckets // 50)
+        self.databases = max(1, instances // 100)
+        self.caches = max(1, instances // 200)
+        self.clusters = max(1, instances // 2000)
+        self.queues = max(1, instances // 50)
+        self.domains = max(1, instances // 1000)
+
+        self.handlers = {
+            ('route53', 'list_hosted_zones'): self.hosted_zones,
+            ('cloudfront', 'list_distributions'): self.distribution_list,
+            ('s3', 'list_buckets'): self.bucket_list,
+            ('s3', 'get_bucket_location'): self.bucket_location,
+            ('s3', 'get_bucket_website'): self.bucket_website,
+            ('elb', 'describe_load_balancers'): self.classic_elb_list,
+            ('elbv2', 'describe_load_balancers'): self.load_balancer_list,
+            ('elbv2', 'describe_target_groups'): self.target_group_list,
+            ('elbv2', 'describe_target_health'): self.target_health,
+            ('rds', 'describe_db_instances'): self.database_list,
+            ('redshift', 'describe_clusters'): self.cluster_list,
+            ('elasticache', 'describe_cache_clusters'): self.cache_list,
+            ('autoscaling', 'describe_auto_scaling_groups'): self.asg_list,
+            ('sqs', 'list_queues'): self.queue_list,
+            ('opensearch', 'list_domain_names'): self.domain_names,
+            ('opensearch', 'describe_domains'): self.domain_list,
+        }
+        self.page_handlers = {
+            ('route53', 'list_resource_record_sets'): self.record_pages,
+            ('ec2', 'describe_instances'): self.instance_pages,
+        }
+
+    def scale(self):
+        ''' The sizes the fixtures were made with '''
+        return {
+            'regions': len(self.regions),
+            'zones': self.zones,
+            'records': self.records,
+            'instances': self.instances,
+            'target_groups': self.target_groups,
+            'buckets': self.buckets,
+        }
+
+    def record_count(self):
+        ''' Total number of records across every query '''
+        return (
+            self.zones * (self.records + 1) + self.instances + self.target_groups * 2
+            + self.buckets * 3 + self.load_balancers + self.classic_elbs + self.asgs
+            + self.distributions + self.databases + self.caches + self.clusters
+            + self.queues + self.domains * 2
+        )
+
+    def fetch(self, api, method, region, kwargs):
+        ''' Stands in for collect.fetch_aws '''
+        handler = self.handlers.get((api, method))
+        if handler is None:
+            raise ValueError('no fixture for {} {}'.format(api, method))
+        return handler(region, kwargs)
+
+    def fetch_pages(self, api, method, region, kwargs):
+        ''' Stands in for collect.fetch_aws_pages '''
+        handler = self.page_handlers.get((api, method))
+        if handler is None:
+            raise ValueError('no paged fixture for {} {}'.format(api, method))
+        return handler(region, kwargs)
+
+    # -------------------------------------------------------------------------
+    # Numbering, each resource is numbered across all the regions
+    # -------------------------------------------------------------------------
+    def region_of(self, number):
+        return self.regions[number % len(self.regions)]
+
+    def in_region(self, total, region):
+        ''' The numbers of the resources, out of total, that are in a region '''
+        return range(self.regions.index(region), total, len(self.regions))
+
+    def nearby(self, total, number, offset=0):
+        ''' A resource, out of total, in the same region as resource number, or None '''
+        first = number % len(self.regions)
+        count = len(range(first, total, len(self.regions)))
+        if not count:
+            return None
+        return first + (number // len(self.regions) + offset) % count * len(self.regions)
+
+    def instance_id(self, number):
+        return 'i-{:017x}'.format(number)
+
+    def public_ip(self, number):
+        return '54.{}.{}.{}'.format((number >> 16) & 255, (number >> 8) & 255, number & 255)
+
+    def load_balancer_dns(self, number):
+        return 'bench-lb-{}-{:09d}.{}.elb.amazonaws.com'.format(
+            number, number * 7919 % 10 ** 9, self.region_of(number))
+
+    def load_balancer_arn(self, number):
+        return 'arn:aws:elasticloadbalancing:{}:{}:loadbalancer/app/bench-lb-{}/{:016x}'.format(
+            self.region_of(number), ACCOUNT, number, number)
+
+    def target_group_arn(self, number):
+        return 'arn:aws:elasticloadbalancing:{}:{}:targetgroup/bench-tg-{}/{:016x}'.format(
+            self.region_of(number), ACCOUNT, number, number)
+
+    def classic_elb_name(self, number):
+        return 'bench-classic-{}'.format(number)
+
+    def database_endpoint(self, number):
+        return 'bench-db-{}.cbench.{}.rds.amazonaws.com'.format(number, self.region_of(number))
+
+    def cache_endpoint(self, number):
+        return 'bench-cache-{}.0001.{}.cache.amazonaws.com'.format(number, self.region_of(number))
+
+    def bucket_name(self, number):
+        # one in ten is named for the domain it serves
+        if number % 10 == 0:
+            return 'assets{}.bench.example.com'.format(number)
+        return 'bench-bucket-{}'.format(number)
+
+    def distribution_domain(self, number):
+        return 'd{:013x}.cloudfront.net'.format(number * 2654435761 % 16 ** 13)
+
+    # -------------------------------------------------------------------------
+    # Route53
+    # -------------------------------------------------------------------------
+    def hosted_zones(self, region, kwargs):
+        return {'HostedZones': [
+            {
+                'Id': '/hostedzone/Z{:012d}'.format(zone),
+                'Name': 'zone{}.bench.example.com.'.format(zone),
+                'ResourceRecordSetCount': self.records,
+            }
+            for zone in range(self.zones)
+        ]}
+
+    def dns_record(self, zone, index):
+        ''' A record in a zone, pointing at one of the other resources '''
+        record = {'Name': 'r{}.zone{}.bench.example.com.'.format(index, zone), 'Type': 'CNAME'}
+        number = zone * self.records + index
+        kind = index % 10
+
+        if kind < 3:
+            value = self.load_balancer_dns(number % self.load_balancers)
+        elif kind == 3:
+            record['Type'] = 'A'
+            record['AliasTarget'] = {
+                'DNSName': 'dualstack.{}.'.format(self.load_balancer_dns(number % self.load_balancers))
+            }
+            return record
+        elif kind == 4:
+            bucket = number % self.buckets // 5 * 5
+            value = '{}.{}'.format(
+                self.bucket_name(bucket),
+                collect.s3_website_regions[self.region_of(bucket)]
+            )
+        elif kind == 5:
+            value = self.database_endpoint(number % self.databases)
+        elif kind == 6:
+            value = self.distribution_domain(number % self.distributions)
+        elif kind == 7:
+            value = EXTERNAL_NAMES[number % len(EXTERNAL_NAMES)]
+        elif kind == 8:
+            record['Type'] = 'A'
+            value = self.public_ip(number % self.instances // 2 * 2)
+        else:
+            record['Type'] = 'TXT'
+            value = '"v=spf1 include:bench.example.com ~all"'
+
+        record['ResourceRecords'] = [{'Value': value}]
+        if index % 20 == 1:
+            record['SetIdentifier'] = 'bench'
+            record['Weight'] = index % 40 // 20
+        return record
+
+    def record_pages(self, region, kwargs):
+        zone = int(kwargs['HostedZoneId'].rpartition('Z')[2])
+        for start in range(0, self.records, DNS_PAGE_SIZE):
+            yield {'ResourceRecordSets': [
+                self.dns_record(zone, index)
+                for index in range(start, min(start + DNS_PAGE_SIZE, self.records))
+            ]}
+
+    # -------------------------------------------------------------------------
+    # Global services - S3, Cloudfront
+    # -------------------------------------------------------------------------
+    def distribution_list(self, region, kwargs):
+        return {'DistributionList': {'Items': [
+            {
+                'DomainName': self.distribution_domain(number),
+                'Id': 'E{:013X}'.format(number),
+                'HttpVersion': 'http2',
+                'Origins': {'Items': [
+                    {'DomainName': '{}.s3.amazonaws.com'.format(self.bucket_name(number * 50 % self.buckets))},
+                ]},
+            }
+            for number in range(self.distributions)
+        ]}}
+
+    def bucket_list(self, region, kwargs):
+        return [
+            {'Name': self.bucket_name(number), 'CreationDate': '2020-01-01T00:00:00Z'}
+            for number in range(self.buckets)
+        ]
+
+    def bucket_number(self, name):
+        return int(name.rpartition('-')[2] if name.startswith('bench-') else name.split('.')[0][6:])
+
+    def bucket_location(self, region, kwargs):
+        return self.region_of(self.bucket_number(kwargs['Bucket']))
+
+    def bucket_website(self, region, kwargs):
+        # one in five buckets is a website
+        if self.bucket_number(kwargs['Bucket']) % 5:
+            return {}
+        return {'IndexDocument': {'Suffix': 'index.html'}, 'ErrorDocument': {'Key': 'error.html'}}
+
+    # -------------------------------------------------------------------------
+    # Regional services
+    # -------------------------------------------------------------------------
+    def instance(self, number):
+        instance = {
+            'InstanceId': self.instance_id(number),
+            'InstanceType': ('t3.medium', 'm5.large', 'c5.xlarge')[number % 3],
+            'PrivateIpAddress': '10.{}.{}.{}'.format((number >> 16) & 255, (number >> 8) & 255, number & 255),
+            'Tags': [
+                {'Key': 'Name', 'Value': 'bench-{}'.format(number)},
+                {'Key': 'InstRole', 'Value': ('web', 'worker', 'queue')[number % 3]},
+            ],
+        }
+        # half the instances are public
+        if number % 2 == 0:
+            instance['PublicIpAddress'] = self.public_ip(number)
+        return instance
+
+    def instance_pages(self, region, kwargs):
+        numbers = self.in_region(self.instances, region)
+        for start in range(0, len(numbers), EC2_PAGE_SIZE):
+            page = numbers[start:start + EC2_PAGE_SIZE]
+            yield {'Reservations': [
+                {
+                    'ReservationId': 'r-{:017x}'.format(page[offset]),
+                    'Instances': [self.instance(number) for number in page[offset:offset + RESERVATION_SIZE]],
+                }
+                for offset in range(0, len(page), RESERVATION_SIZE)
+            ]}
+
+    def nearby_instances(self, number, count):
+        ''' Instance ids in the same region as resource number '''
+        found = (self.nearby(self.instances, number, offset) for offset in range(count))
+        return [self.instance_id(instance) for instance in found if instance is not None]
+
+    def classic_elb_list(self, region, kwargs):
+        return {'LoadBalancerDescriptions': [
+            {
+                'LoadBalancerName': self.classic_elb_name(number),
+                'DNSName': '{}-{:09d}.{}.elb.amazonaws.com'.format(
+                    self.classic_elb_name(number), number * 7919 % 10 ** 9, region),
+                'Instances': [{'InstanceId': instance} for instance in self.nearby_instances(number, 3)],
+            }
+            for number in self.in_region(self.classic_elbs, region)
+        ]}
+
+    def load_balancer_list(self, region, kwargs):
+        return {'LoadBalancers': [
+            {
+                'LoadBalancerArn': self.load_balancer_arn(number),
+                'DNSName': self.load_balancer_dns(number),
+                'LoadBalancerName': 'bench-lb-{}'.format(number),
+                'Type': 'application',
+            }
+            for number in self.in_region(self.load_balancers, region)
+        ]}
+
+    def target_group_list(self, region, kwargs):
+        groups = []
+        for number in self.in_region(self.target_groups, region):
+            load_balancer = self.nearby(self.load_balancers, number)
+            groups.append({
+                'TargetGroupArn': self.target_group_arn(number),
+                'TargetGroupName': 'bench-tg-{}'.format(number),
+                'LoadBalancerArns': [] if load_balancer is None else [self.load_balancer_arn(load_balancer)],
+            })
+        return {'TargetGroups': groups}
+
+    def target_health(self, region, kwargs):
+        number = int(kwargs['TargetGroupArn'].rpartition('/')[2], 16)
+        return {'TargetHealthDescriptions': [
+            {'Target': {'Id': instance, 'Port': 80}, 'TargetHealth': {'State': 'healthy'}}
+            for instance in self.nearby_instances(number * 4, 4)
+        ]}
+
+    def database_list(self, region, kwargs):
+        databases = []
+        for number in self.in_region(self.databases, region):
+            database = {
+                'DBInstanceIdentifier': 'bench-db-{}'.format(number),
+                'DBInstanceArn': 'arn:aws:rds:{}:{}:db:bench-db-{}'.format(region, ACCOUNT, number),
+                'DBInstanceClass': 'db.r5.large',
+                'Engine': 'mysql',
+                'Endpoint': {'Address': self.database_endpoint(number), 'Port': 3306},
+            }
+            # every fourth database is a replica of the one before it in the region
+            source = number - len(self.regions)
+            if number % 4 == 3 and source >= 0:
+                database['ReadReplicaSourceDBInstanceIdentifier'] = 'bench-db-{}'.format(source)
+            databases.append(database)
+        return {'DBInstances': databases}
+
+    def cluster_list(self, region, kwargs):
+        return {'Clusters': [
+            {
+                'ClusterIdentifier': 'bench-rs-{}'.format(number),
+                'NodeType': 'dc2.large',
+                'Endpoint': {'Address': 'bench-rs-{}.cbench.{}.redshift.amazonaws.com'.format(number, region)},
+            }
+            for number in self.in_region(self.clusters, region)
+        ]}
+
+    def cache_list(self, region, kwargs):
+        return {'CacheClusters': [
+            {
+                'ARN': 'arn:aws:elasticache:{}:{}:cluster:bench-cache-{}'.format(region, ACCOUNT, number),
+                'CacheClusterId': 'bench-cache-{}'.format(number),
+                'CacheNodeType': 'cache.m5.large',
+                'Engine': 'redis',
+                'CacheNodes': [{'Endpoint': {'Address': self.cache_endpoint(number), 'Port': 6379}}],
+            }
+            for number in self.in_region(self.caches, region)
+        ]}
+
+    def asg_list(self, region, kwargs):
+        groups = []
+        for number in self.in_region(self.asgs, region):
+            elb = self.nearby(self.classic_elbs, number)
+            groups.append({
+                'AutoScalingGroupName': 'bench-asg-{}'.format(number),
+                'LoadBalancerNames': [] if elb is None else [self.classic_elb_name(elb)],
+                'Instances': [{'InstanceId': instance} for instance in self.nearby_instances(number * 3, 3)],
+            })
+        return {'AutoScalingGroups': groups}
+
+    def queue_list(self, region, kwargs):
+        return [
+            'https://sqs.{}.amazonaws.com/{}/bench-queue-{}'.format(region, ACCOUNT, number)
+            for number in self.in_region(self.queues, region)
+        ]
+
+    def domain_names(self, region, kwargs):
+        return [
+            {'DomainName': 'bench-search-{}'.format(number), 'EngineType': 'OpenSearch'}
+            for number in self.in_region(self.domains, region)
+        ]
+
+    def domain_list(self, region, kwargs):
+        return [
+            {
+                'ARN': 'arn:aws:es:{}:{}:domain/{}'.format(region, ACCOUNT, name),
+                'DomainName': name,
+                'EngineVersion': 'OpenSearch_2.11',
+                'ClusterConfig': {'InstanceType': 'r6g.large.search', 'InstanceCount': 3},
+                'Endpoints': {'vpc': 'vpc-{}-bench.{}.es.amazonaws.com'.format(name, region)},
+            }
+            for name in kwargs['DomainNames']
+        ]
+
+
+def parse_args(argv=None):
+    ''' Parse the command line options '''
+    parser = argparse.ArgumentParser(description='Benchmark collect.py against made up AWS data')
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help='Multiply the number of zones, instances, target groups and buckets '
+                             'by this (default: %(default)s)')
+    parser.add_argument('--zones', type=int, default=1000, help='Hosted zones (default: %(default)s)')
+    parser.add_argument('--records', type=int, default=500, help='Records per zone (default: %(default)s)')
+    parser.add_argument('--instances', type=int, default=20000, help='EC2 instances (default: %(default)s)')
+    parser.add_argument('--target-groups', type=int, default=2000, help='Target groups (default: %(default)s)')
+    parser.add_argument('--buckets', type=int, default=5000, help='S3 buckets (default: %(default)s)')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Time each warm run this many times and keep the best (default: %(default)s)')
+    parser.add_argument('--workers', type=int, default=collect.max_workers,
+                        help='Workers for the main() runs (default: %(default)s)')
+    parser.add_argument('--main-args', default='',
+                        help='More options for the main() runs, eg "--no-layout --cache-backend sqlite"')
+    parser.add_argument('--no-memory', action='store_true',
+                        help='Skip the extra runs that measure peak memory with tracemalloc')
+    parser.add_argument('--baseline', metavar='FILE',
+                        help='Compare with saved results, exit 1 on a regression or a change in the output')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='How much slower, or bigger, than the baseline is a regression (default: %(default)s)')
+    parser.add_argument('--save-baseline', metavar='FILE', help='Save the results to compare against later')
+    parser.add_argument('--keep', action='store_true', help='Keep the working directory with the cache and data')
+    parser.add_argument('--verbose', action='store_true', help="Show collect.py's logging")
+    return parser.parse_args(argv)
+
+
+def make_fixtures(args):
+    ''' Fixtures sized from the command line '''
+    def scaled(value):
+        return max(1, int(round(value * args.scale)))
+
+    return Fixtures(
+        collect.region_list,
+        zones=scaled(args.zones),
+        records=args.records,
+        instances=scaled(args.instances),
+        target_groups=scaled(args.target_groups),
+        buckets=scaled(args.buckets),
+    )
+
+
+def install(fixtures):
+    ''' Point collect.py at the fixtures rather than AWS '''
+    collect.fetch_aws = fixtures.fetch
+    collect.fetch_aws_pages = fixtures.fetch_pages
+    collect.account_id = ACCOUNT
+
+
+def reset_memo():
+    ''' Forget the query results collect.py keeps in memory, as a new run would '''
+    with collect.memo_lock:
+        collect.memo.clear()
+
+
+def best_of(repeat, func):
+    ''' Call func repeat times, returning the fastest time and the last result '''
+    best = None
+    result = None
+    for _ in range(max(1, repeat)):
+        reset_memo()
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def peak_memory(func):
+    ''' Call func with tracemalloc running, returning the peak in MB '''
+    reset_memo()
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+    finally:
+        tracemalloc.stop()
+
+
+def output_summary(data_dir):
+    ''' Count and hash the CSVs written by main(), to spot changes in the output '''
+    summary = {}
+    digest = sha1()
+    for name in ('nodes', 'edges'):
+        with open(os.path.join(data_dir, name + '.csv'), 'rb') as file:
+            content = file.read()
+        digest.update(content)
+        summary[name] = content.count(b'\n') - 1
+    summary['digest'] = digest.hexdigest()
+    return summary
+
+
+def time_collectors(args):
+    '''
+    Time every collector against the cache, run one unit after another,
+    with the times of a collector's units added up. Returns the timings
+    and the merged nodes and edges.
+    '''
+    units = collect.build_units(collect.global_region, collect.region_list)
+    names = [collector.func.__name__ for _, collector in units]
+
+    def run_units():
+        results = []
+        for name, (unit_name, collector) in zip(names, units):
+            start = time.perf_counter()
+            unit_nodes, unit_edges = collect.run_unit(unit_name, collector)
+            results.append((name, time.perf_counter() - start, unit_nodes, unit_edges))
+        return results
+
+    timings = {}
+    for _ in range(max(1, args.repeat)):
+        reset_memo()
+        totals = {}
+        for name, elapsed, unit_nodes, unit_edges in run_units():
+            total = totals.setdefault(name, {'seconds': 0.0, 'calls': 0, 'nodes': 0, 'edges': 0})
+            total['seconds'] += elapsed
+            total['calls'] += 1
+            total['nodes'] += len(unit_nodes)
+            total['edges'] += len(unit_edges)
+        for name, total in totals.items():
+            if name not in timings or total['seconds'] < timings[name]['seconds']:
+                timings[name] = total
+
+    nodes = {}
+    edges = {}
+    results = run_units()
+    for _, _, unit_nodes, unit_edges in results:
+        collect.merge_graph(nodes, edges, unit_nodes, unit_edges)
+
+    if not args.no_memory:
+        for name in timings:
+            group = [unit for unit_name, unit in zip(names, units) if unit_name == name]
+            timings[name]['peak_mb'] = peak_memory(
+                lambda: [collect.run_unit(*unit) for unit in group]
+            )
+
+    for timing in timings.values():
+        timing['nodes_per_second'] = timing['nodes'] / timing['seconds'] if timing['seconds'] else None
+
+    return timings, nodes, edges
+
+
+def time_write_csv(args, nodes, edges):
+    ''' Time writing the nodes and edges CSVs '''
+    def write():
+        collect.write_csv(nodes.values(), 'bench_nodes.csv', collect.node_fields)
+        collect.write_csv(edges.values(), 'bench_edges.csv', collect.edge_fields)
+
+    seconds, _ = best_of(args.repeat, write)
+    rows = len(nodes) + len(edges)
+    timing = {'seconds': seconds, 'rows': rows, 'rows_per_second': rows / seconds if seconds else None}
+    if not args.no_memory:
+        timing['peak_mb'] = peak_memory(write)
+    return timing
+
+
+def run_benchmark(args, fixtures):
+    ''' Run everything in the current directory, returning the results '''
+    main_args = ['--workers', str(args.workers), '--cache-max-mb', str(1024 * 1024)] + shlex.split(args.main_args)
+    records = fixtures.record_count()
+
+    def run_main():
+        collect.main(main_args)
+
+    timings = {}
+
+    start = time.perf_counter()
+    run_main()
+    seconds = time.perf_counter() - start
+    timings['main cold'] = {'seconds': seconds, 'records': records, 'records_per_second': records / seconds}
+    output = output_summary('data')
+
+    seconds, _ = best_of(args.repeat, run_main)
+    timings['main warm'] = {'seconds': seconds, 'records': records, 'records_per_second': records / seconds}
+    if not args.no_memory:
+        timings['main warm']['peak_mb'] = peak_memory(run_main)
+
+    collectors, nodes, edges = time_collectors(args)
+    timings.update(collectors)
+    timings['write_csv'] = time_write_csv(args, nodes, edges)
+
+    # last, as it leaves collect.py offline
+    def run_offline():
+        collect.main(main_args + ['--offline'])
+
+    seconds, _ = best_of(args.repeat, run_offline)
+    timings['main offline'] = {'seconds': seconds, 'records': records, 'records_per_second': records / seconds}
+
+    return {
+        'version': bench_version,
+        'scale': fixtures.scale(),
+        'python': platform.python_version(),
+        'main_args': main_args,
+        'timings': timings,
+        'output': output,
+    }
+
+
+def format_number(value, places=0):
+    if value is None:
+        return '-'
+    return '{:,.{}f}'.format(value, places)
+
+
+def report(results):
+    ''' Print the timings as a table '''
+    print('scale: ' + ', '.join('{}={}'.format(key, value) for key, value in results['scale'].items()))
+    print('output: {nodes} nodes, {edges} edges, digest {digest}'.format(**results['output']))
+    print()
+    print('{:<24} {:>10} {:>7} {:>9} {:>9} {:>20} {:>9}'.format(
+        'timing', 'seconds', 'calls', 'nodes', 'edges', 'throughput', 'peak MB'))
+    for name, timing in results['timings'].items():
+        for unit in ('nodes', 'records', 'rows'):
+            if unit + '_per_second' in timing:
+                rate = format_number(timing[unit + '_per_second']) + ' ' + unit + '/s'
+        print('{:<24} {:>10} {:>7} {:>9} {:>9} {:>20} {:>9}'.format(
+            name,
+            format_number(timing['seconds'], 3),
+            format_number(timing.get('calls')),
+            format_number(timing.get('nodes')),
+            format_number(timing.get('edges')),
+            rate,
+            format_number(timing.get('peak_mb'), 1),
+        ))
+
+
+def compare(results, baseline, tolerance):
+    '''
+    Compare results with a baseline. Returns a list of regressions, slower
+    or bigger than the baseline by more than the tolerance, or changes to
+    the output.
+    '''
+    if baseline.get('version') != results['version'] or baseline.get('scale') != results['scale']:
+        return ['baseline was made with a different version or scale: {}'.format(baseline.get('scale'))]
+
+    problems = []
+    if baseline['output'] != results['output']:
+        problems.append('output changed: {} nodes, {} edges, was {} nodes, {} edges'.format(
+            results['output']['nodes'], results['output']['edges'],
+            baseline['output']['nodes'], baseline['output']['edges']))
+
+    print()
+    print('{:<24} {:>10} {:>10} {:>8}'.format('compared to baseline', 'seconds', 'baseline', 'change'))
+    for name, timing in results['timings'].items():
+        before = baseline['timings'].get(name)
+        if before is None:
+            continue
+
+        change = timing['seconds'] / before['seconds'] - 1 if before['seconds'] else 0
+        slower = change > tolerance and timing['seconds'] - before['seconds'] > NOISE_SECONDS
+        print('{:<24} {:>10.3f} {:>10.3f} {:>+7.0%}{}'.format(
+            name, timing['seconds'], before['seconds'], change, '  SLOWER' if slower else ''))
+        if slower:
+            problems.append('{} is {:.0%} slower'.format(name, change))
+
+        if timing.get('peak_mb') and before.get('peak_mb'):
+            growth = timing['peak_mb'] / before['peak_mb'] - 1
+            if growth > tolerance and timing['peak_mb'] - before['peak_mb'] > NOISE_MB:
+                problems.append('{} peak memory is {:.0%} higher'.format(name, growth))
+
+    return problems
+
+
+def main(argv=None):
+    ''' Main function to kick it all off '''
+    args = parse_args(argv)
+    if not args.verbose:
+        logger.setLevel(logging.WARNING)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+
+    fixtures = make_fixtures(args)
+    install(fixtures)
+
+    working_dir = tempfile.mkdtemp(prefix='infra-viz-bench-')
+    cwd = os.getcwd()
+    os.chdir(working_dir)
+    try:
+        results = run_benchmark(args, fixtures)
+    finally:
+        os.chdir(cwd)
+        if args.keep:
+            print('working directory kept in {}'.format(working_dir))
+        else:
+            collect.get_cache().close()
+            shutil.rmtree(working_dir, ignore_errors=True)
+
+    report(results)
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as file:
+            json.dump(results, file, indent=1, sort_keys=True)
+
+    if baseline is not None:
+        problems = compare(results, baseline, args.tolerance)
+        if problems:
+            print()
+            for problem in problems:
+                print('REGRESSION: ' + problem)
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    # execute only if run as a script
+    main()
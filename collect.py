@@ -2,13 +2,32 @@
 # -*- coding: utf-8 -*-
 
 import os
+import sys
 import logging
 import json
 import csv
+import gzip
+import multiprocessing
+import sqlite3
+import zlib
+import argparse
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import date, datetime
+from functools import partial
 from hashlib import sha1
-import botocore
-import boto3
+
+# boto3 and botocore are imported when first needed, so --offline runs
+# never load them
+
+from external import default_services_file, load_services
+from graph import Graph, save_gzip_json
+from layout import layout_graph, read_layout, save_layout
+from metrics import THROTTLE_CODES, Metrics, prometheus_text
+from shards import write_shards
 
 logger = logging.getLogger('main')
 logger.setLevel(logging.DEBUG)
@@ -19,24 +38,253 @@ ch.setLevel(logging.DEBUG)
 
 account_id = None
 
+# Only read from the cache, never AWS, see --offline
+offline = False
+
+# Number of collection units (region, collector) to run at once
+max_workers = 8
+
+# Where query_aws caches results, and the store it caches them in
+cache_dir = 'cache'
+cache_store = None
+
+# With --profiles or --roles each account has its own cache and data
+# directories under these
+accounts_cache_dir = cache_dir
+accounts_data_dir = 'data/accounts'
+
+# Cache keys of results cached a page at a time start with this
+pages_prefix = 'pages.'
+
+# How long, in seconds, cached results stay fresh for each AWS api.
+# Things that rarely change can live a long time, instances come and go.
+HOUR = 60 * 60
+DAY = 24 * HOUR
+cache_ttls = {
+    'route53': 7 * DAY,
+    's3': 7 * DAY,
+    'sts': 30 * DAY,
+    'cloudfront': DAY,
+    'rds': 6 * HOUR,
+    'redshift': 6 * HOUR,
+    'elasticache': 6 * HOUR,
+    'opensearch': 6 * HOUR,
+    'sqs': 6 * HOUR,
+    'elb': HOUR,
+    'elbv2': HOUR,
+    'ec2': HOUR,
+    'autoscaling': HOUR,
+}
+default_cache_ttl = HOUR
+
+# Total size the cache can grow to before the least recently used files go
+cache_max_bytes = 500 * 1024 * 1024
+
+# In-memory memo of query results in front of the cache files, keyed on
+# (api, method, region, cache_key) and holding (time fetched, records)
+memo = OrderedDict()
+memo_lock = threading.Lock()
+memo_size = 10000
+memo_missing = object()
+
+# Queries currently being fetched, so identical queries can wait on them
+inflight = {}
+inflight_lock = threading.Lock()
+
+# Processes decoding cached results in bulk, see decode_in_parallel.
+# Starting them costs more than decoding a few thousand results.
+decode_workers = os.cpu_count() or 1
+decode_chunk_size = 500
+decode_min_chunks = 4
+decode_pool = None
+decode_pool_lock = threading.Lock()
+
+# Bump when the incremental state format changes so old state is ignored
+state_version = 4
+
+# Queries made by the collection unit running on each thread, see recording(),
+# and the uncached records its replay fetched, see replay_fingerprint()
+recorder = threading.local()
+
+# Number of per item lookups, eg target health per target group, to run at once
+fan_out_workers = 16
+
+# boto3 sessions are not thread safe, so each thread creates clients from
+# its own session, made with session_settings (profile or credentials).
+# The clients themselves are thread safe and shared, keyed on (api, region)
+session_settings = {}
+sessions = threading.local()
+clients = {}
+clients_lock = threading.Lock()
+
+# Settings used when creating clients
+client_settings = {
+    'max_pool_connections': 20,
+    'max_attempts': 10,
+    'retry_mode': 'adaptive',
+}
+
+# Timings and counters of this run, see metrics.py
+run_metrics = Metrics()
+
+# Regions to collect
+# TODO: This should come from config file
+region_list = [
+    'us-west-1', 'us-west-2', 'us-east-1', 'eu-west-1', 'ap-southeast-2'
+    # 'us-west-1'
+]
+
+# Region used for "global" AWS services
+global_region = 'us-east-1'
+
+# Classifier of DNS names pointing at external services, and the file it
+# is loaded from, see external.py
+external_services = None
+external_services_file = default_services_file
+
 logger.addHandler(ch)
 
-node_fields = [
+# S3 Website domain names from here:
+# https://docs.aws.amazon.com/general/latest/gr/s3.html#s3_website_region_endpoints
+s3_website_regions = {
+    "us-east-1": "s3-website-us-east-1.amazonaws.com",
+    "us-east-2": "s3-website.us-east-2.amazonaws.com",
+    "us-west-1": "s3-website-us-west-1.amazonaws.com",
+    "us-west-2": "s3-website-us-west-2.amazonaws.com",
+    "af-south-1":"s3-website.af-south-1.amazonaws.com",
+    "ap-east-1":"s3-website.ap-east-1.amazonaws.com",
+    "ap-south-1":"s3-website.ap-south-1.amazonaws.com",
+    "ap-northeast-3":"s3-website.ap-northeast-3.amazonaws.com",
+    "ap-northeast-2":"s3-website.ap-northeast-2.amazonaws.com",
+    "ap-southeast-1":"s3-website-ap-southeast-1.amazonaws.com",
+    "ap-southeast-2":"s3-website-ap-southeast-2.amazonaws.com",
+    "ap-northeast-1":"s3-website-ap-northeast-1.amazonaws.com",
+    "ca-central-1":"s3-website.ca-central-1.amazonaws.com",
+    "cn-northwest-1":"s3-website.cn-northwest-1.amazonaws.com.cn",
+    "eu-central-1":"s3-website.eu-central-1.amazonaws.com",
+    "eu-west-1":"s3-website-eu-west-1.amazonaws.com",
+    "eu-west-2":"s3-website.eu-west-2.amazonaws.com",
+    "eu-south-1":"s3-website.eu-south-1.amazonaws.com",
+    "eu-west-3":"s3-website.eu-west-3.amazonaws.com",
+    "eu-north-1":"s3-website.eu-north-1.amazonaws.com",
+    "me-south-1":"s3-website.me-south-1.amazonaws.com",
+    "sa-east-1":"s3-website-sa-east-1.amazonaws.com",
+    "us-gov-east-1":"s3-website.us-gov-east-1.amazonaws.com",
+    "us-gov-west-1":"s3-website-us-gov-west-1.amazonaws.com",
+}
+
+node_fields = (
     'type',
     'name',
     'description',
+    'region',
     'weight',
     'counter'
-]
+)
 
-edge_fields = [
+edge_fields = (
     'from_type',
     'from_name',
     'edge',
     'to_type',
     'to_name',
-    'weight'
-]
+    'weight',
+    'counter'
+)
+
+
+def intern_label(value):
+    ''' Intern a label repeated on many records (types, edges, regions) so it is stored once '''
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+class Node:
+    '''
+    A node in the graph. Slots rather than a dict per node, with the
+    repeated type and region strings interned, keeps large graphs small.
+    '''
+    __slots__ = node_fields
+
+    def __init__(self, type=None, name=None, description=None, region=None, weight=None, counter=None):
+        self.type = intern_label(type)
+        self.name = name
+        self.description = description
+        self.region = intern_label(region)
+        self.weight = weight
+        self.counter = counter
+
+    def row(self):
+        ''' The node's values in node_fields order '''
+        return (self.type, self.name, self.description, self.region, self.weight, self.counter)
+
+    def copy(self):
+        ''' A copy of the node '''
+        return Node(*self.row())
+
+    def to_dict(self):
+        ''' The node as a dict of node_fields '''
+        return dict(zip(node_fields, self.row()))
+
+    def __eq__(self, other):
+        return isinstance(other, Node) and self.row() == other.row()
+
+    def __repr__(self):
+        return 'Node{}'.format(self.row())
+
+
+class Edge:
+    '''
+    An edge in the graph. Slots rather than a dict per edge, with the
+    repeated type and edge label strings interned, keeps large graphs small.
+    '''
+    __slots__ = edge_fields
+
+    def __init__(self, from_type=None, from_name=None, edge=None, to_type=None, to_name=None,
+                 weight=None, counter=None):
+        self.from_type = intern_label(from_type)
+        self.from_name = from_name
+        self.edge = intern_label(edge)
+        self.to_type = intern_label(to_type)
+        self.to_name = to_name
+        self.weight = weight
+        self.counter = counter
+
+    def row(self):
+        ''' The edge's values in edge_fields order '''
+        return (self.from_type, self.from_name, self.edge, self.to_type, self.to_name,
+                self.weight, self.counter)
+
+    def copy(self):
+        ''' A copy of the edge '''
+        return Edge(*self.row())
+
+    def to_dict(self):
+        ''' The edge as a dict of edge_fields '''
+        return dict(zip(edge_fields, self.row()))
+
+    def __eq__(self, other):
+        return isinstance(other, Edge) and self.row() == other.row()
+
+    def __repr__(self):
+        return 'Edge{}'.format(self.row())
+
+
+class CacheMissError(Exception):
+    ''' A query that is not in the cache when running --offline '''
+
+    def __init__(self, api, method, region, kwargs):
+        # every argument goes to Exception so the error can be pickled back
+        # from an account's process
+        super().__init__(api, method, region, kwargs)
+        self.api = api
+        self.method = method
+        self.region = region
+        self.kwargs = kwargs
+
+    def __str__(self):
+        return 'not in the cache: {} {} {} {}'.format(
+            self.api, self.method, self.region,
+            json.dumps(self.kwargs, sort_keys=True, default=json_serial))
 
 
 def make_dirs(folder):
@@ -45,10 +293,12 @@ def make_dirs(folder):
         os.makedirs(folder)
 
 def write_json_file(filename, obj):
-    ''' Save an object as a json file '''
-    with open(filename, 'w+') as file:
+    ''' Save an object as a json file, replacing any existing file in one go '''
+    tmp_filename = '{}.{}.tmp'.format(filename, threading.get_ident())
+    with open(tmp_filename, 'w+') as file:
         file.write(json.dumps(obj, default=json_serial))
-        logger.debug("wrote file: %s", filename)
+    os.replace(tmp_filename, filename)
+    logger.debug("wrote file: %s", filename)
 
 
 def read_json_file(filename):
@@ -60,12 +310,12 @@ def read_json_file(filename):
 
 
 def write_csv(nodes, filename, fieldnames):
-    ''' Write out all the nodes to a CSV File '''
+    ''' Write out all the nodes (or edges) to a CSV File, a row at a time '''
 
     with open(filename, 'w+', newline='') as csvfile:
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-        writer.writeheader()
-        writer.writerows(nodes)
+        writer = csv.writer(csvfile)
+        writer.writerow(fieldnames)
+        writer.writerows(node.row() for node in nodes)
 
     logger.debug("wrote file: %s", filename)
 
@@ -88,57 +338,820 @@ def fmt_dns(name):
 
 def new_node(**kwargs):
     ''' Creates a new node and will populate the fields that match in kwargs '''
-    return {key: kwargs.get(key, None) for key in node_fields}
+    return Node(**kwargs)
 
 
 def new_edge(**kwargs):
     ''' Creates a new edge and will populate the fields that match in kwargs '''
-    return {key: kwargs.get(key, None) for key in edge_fields}
+    return Edge(**kwargs)
+
+
+def node_key(node):
+    ''' The key of a node, which is also its id in the frontend '''
+    return node.type+'_'+node.name
 
 
 def add_update_node(existing_nodes,node):
     '''
     Adds a node to the array - or increments the weight if a duplicate
     '''
-    node_name = node['type']+'_'+node['name']
+    node_name = node_key(node)
     if node_name in existing_nodes:
-        existing_nodes[node_name]['counter'] += 1
+        existing_nodes[node_name].counter += 1
     else:
         existing_nodes[node_name] = node
-        existing_nodes[node_name]['counter'] = 1
+        existing_nodes[node_name].counter = 1
+
+def edge_key(edge):
+    ''' The key of an edge, its endpoints and type '''
+    return (edge.from_type, edge.from_name, edge.edge, edge.to_type, edge.to_name)
+
+
+def add_update_edge(existing_edges, edge):
+    '''
+    Adds an edge to the dict - or if a duplicate, increments its counter and
+    adds on its weight
+    '''
+    key = edge_key(edge)
+    if key in existing_edges:
+        existing_edges[key].counter += 1
+        existing_edges[key].weight += edge.weight
+    else:
+        existing_edges[key] = edge
+        existing_edges[key].counter = 1
+
+
+def configure_clients(**kwargs):
+    '''
+    Update the client settings (max_pool_connections, max_attempts,
+    retry_mode) and drop any clients created with the old ones
+    '''
+    global sessions
+    with clients_lock:
+        client_settings.update(
+            {key: value for key, value in kwargs.items() if value is not None}
+        )
+        sessions = threading.local()
+        clients.clear()
+
+
+def get_session():
+    ''' The boto3 session of this thread, made with session_settings '''
+    import boto3
+
+    session = getattr(sessions, 'session', None)
+    if session is None:
+        session = sessions.session = boto3.session.Session(**session_settings)
+    return session
+
+
+def get_client(api, region):
+    '''
+    Get the client for an api and region, creating it once from this
+    thread's session. The lock makes sure only one client is created per
+    api and region.
+    '''
+    key = (api, region)
+    client = clients.get(key)
+    if client is not None:
+        return client
+
+    import botocore.config
+
+    with clients_lock:
+        if key not in clients:
+            config = botocore.config.Config(
+                max_pool_connections=client_settings['max_pool_connections'],
+                retries={
+                    'max_attempts': client_settings['max_attempts'],
+                    'mode': client_settings['retry_mode'],
+                }
+            )
+            client = get_session().client(api, region_name=region, config=config)
+            client.meta.events.register('after-call', partial(count_response, api, region))
+            client.meta.events.register('needs-retry', partial(count_throttle, api, region))
+            clients[key] = client
+            logger.debug("created client: %s %s", api, region)
+
+        return clients[key]
+
+
+def count_response(api, region, parsed=None, model=None, **kwargs):
+    ''' Count an AWS request and its retries, botocore calls this after every call '''
+    import botocore
+
+    retries = (parsed or {}).get('ResponseMetadata', {}).get('RetryAttempts', 0)
+    run_metrics.add_query(api, botocore.xform_name(model.name), region, requests=1, retries=retries)
+
+
+def count_throttle(api, region, response=None, operation=None, **kwargs):
+    ''' Count throttled attempts, botocore calls this after every attempt '''
+    import botocore
+
+    if response is not None and response[1].get('Error', {}).get('Code') in THROTTLE_CODES:
+        run_metrics.add_query(api, botocore.xform_name(operation.name), region, throttles=1)
+
+
+def configure_session(profile=None, role_arn=None):
+    '''
+    Create clients from now on with a named profile, or with a role assumed
+    using the profile (or the default credentials)
+    '''
+    import boto3
+
+    global session_settings, sessions
+    with clients_lock:
+        session_settings = {'profile_name': profile}
+        if role_arn:
+            credentials = boto3.session.Session(**session_settings).client('sts').assume_role(
+                RoleArn=role_arn,
+                RoleSessionName='infra-viz',
+            )['Credentials']
+            session_settings = {
+                'aws_access_key_id': credentials['AccessKeyId'],
+                'aws_secret_access_key': credentials['SecretAccessKey'],
+                'aws_session_token': credentials['SessionToken'],
+            }
+        sessions = threading.local()
+        clients.clear()
+
 
 def get_aws_account_id():
+    ''' The account id of the credentials in use, cached like any other query '''
     global account_id
     if account_id is None:
-        account_id = boto3.client("sts").get_caller_identity()["Account"]
+        account_id = query_aws('sts', 'get_caller_identity', None)['Account']
 
     return account_id
 
-def query_aws(api, method, region, cached=True, **kwargs):
+def cache_key(kwargs):
     '''
-    Query AWS API using api and method to call for a given region
-    Cache the results to the filesystem for faster re-run. Can flush cache
-    with flag when required
+    Hash the query arguments into a key. The arguments are normalised to
+    JSON with sorted keys so the same query always gives the same key.
     '''
-    # build up the filename
-    filename = [api, method, region]
+    canonical = json.dumps(
+        kwargs,
+        sort_keys=True,
+        separators=(',', ':'),
+        default=json_serial
+    )
+    return sha1(canonical.encode()).hexdigest()
 
-    # add kwargs as a hash to the filename
-    filename.append(sha1(str(kwargs).encode()).hexdigest())
 
-    # construct filename and add path
-    filename = os.path.join('cache', '-'.join(filename)) + '.json'
+def cache_ttl(api):
+    ''' How long, in seconds, results for an api stay fresh. None, forever, when offline '''
+    if offline:
+        return None
+    return cache_ttls.get(api, default_cache_ttl)
 
-    try:
-        # look for a cache file, return result if found
-        if cached:
-            return read_json_file(filename)
 
-    except IOError:
-        pass
+def parse_ttl(value):
+    ''' Parse an API=SECONDS --ttl option into (api, seconds) '''
+    api, _, seconds = value.partition('=')
+    if not api or not seconds.isdigit():
+        raise argparse.ArgumentTypeError(
+            "expected API=SECONDS, eg ec2=600, got '{}'".format(value))
+    return api, int(seconds)
+
 
+def is_pages_key(key):
+    ''' Whether a cache key is for a result cached a page at a time '''
+    return key.startswith(pages_prefix)
+
+
+class FileCache:
+    '''
+    Cache store keeping each query result in its own JSON file
+    named <api>-<method>-<region>-<key>.json. The modified time of a file is
+    when it was fetched and the access time is when it was last used.
+    Results cached a page at a time are JSON lines files, one page per line.
+    A read only cache leaves the access times alone.
+    '''
+
+    def __init__(self, folder, read_only=False):
+        self.folder = folder
+        self.read_only = read_only
+        make_dirs(folder)
+
+    def filename(self, api, method, region, key):
+        ''' Build the cache filename for a query '''
+        extension = '.jsonl' if is_pages_key(key) else '.json'
+        return os.path.join(self.folder, '-'.join([api, method, str(region), key])) + extension
+
+    @staticmethod
+    def parse_filename(filename):
+        '''
+        Split a cache filename back into its api, method, region and key.
+        Returns None if it is not a cache file.
+        '''
+        name, extension = os.path.splitext(os.path.basename(filename))
+        if extension not in ('.json', '.jsonl'):
+            return None
+
+        # api and method never contain a dash, regions do
+        parts = name.split('-', 2)
+        if len(parts) != 3:
+            return None
+
+        region, _, key = parts[2].rpartition('-')
+        if not region:
+            return None
+
+        return parts[0], parts[1], region, key
+
+    def entries(self, api=None, method=None, region=None):
+        ''' List (api, method, region, key, filename) for matching cache files '''
+        if not os.path.isdir(self.folder):
+            return []
+
+        entries = []
+        for name in os.listdir(self.folder):
+            parsed = self.parse_filename(name)
+            if parsed is None:
+                continue
+            if api and api != parsed[0]:
+                continue
+            if method and method != parsed[1]:
+                continue
+            if region and region != parsed[2]:
+                continue
+            entries.append(parsed + (os.path.join(self.folder, name),))
+
+        return entries
+
+    def read(self, filename, max_age=None):
+        ''' Read a cache file, returning (fetched, records) or None '''
+        try:
+            fetched = os.path.getmtime(filename)
+            if max_age is not None and time.time() - fetched > max_age:
+                return None
+            records = read_json_file(filename)
+        except (IOError, ValueError):
+            return None
+
+        self.touch(filename, fetched)
+        return fetched, records
+
+    def touch(self, filename, fetched):
+        ''' Mark a file used now, keeping its modified time as when it was fetched '''
+        if self.read_only:
+            return
+        try:
+            os.utime(filename, (time.time(), fetched))
+        except OSError:
+            pass
+
+    def get(self, api, method, region, key, max_age=None):
+        ''' Get (fetched, records) for a query, or None if missing or too old '''
+        filename = self.filename(api, method, region, key)
+        result = self.read(filename, max_age)
+        if result is not None:
+            run_metrics.add_query(api, method, region, cache_read_bytes=os.path.getsize(filename))
+        return result
+
+    def get_pages(self, api, method, region, key, max_age=None):
+        '''
+        Get (fetched, pages) for a query cached a page at a time, where pages
+        reads the pages one at a time. None if missing or too old.
+        '''
+        filename = self.filename(api, method, region, key)
+        try:
+            stat = os.stat(filename)
+            fetched = stat.st_mtime
+            if max_age is not None and time.time() - fetched > max_age:
+                return None
+        except OSError:
+            return None
+
+        self.touch(filename, fetched)
+
+        run_metrics.add_query(api, method, region, cache_read_bytes=stat.st_size)
+        return fetched, self.read_pages(filename)
+
+    @staticmethod
+    def read_pages(filename):
+        ''' Read the pages of a JSON lines file one at a time '''
+        with open(filename, 'r') as file:
+            for line in file:
+                yield json.loads(line)
+        logger.debug("read file: %s", filename)
+
+    def put_pages(self, api, method, region, key, pages, fetched=None):
+        '''
+        Save pages of records for a query as they pass through, yielding each
+        page on. The file only replaces any existing one once all pages are in.
+        '''
+        filename = self.filename(api, method, region, key)
+        tmp_filename = '{}.{}.tmp'.format(filename, threading.get_ident())
+        try:
+            with open(tmp_filename, 'w+') as file:
+                for page in pages:
+                    file.write(json.dumps(page, default=json_serial) + '\n')
+                    yield page
+                size = file.tell()
+            os.replace(tmp_filename, filename)
+            run_metrics.add_query(api, method, region, cache_written_bytes=size)
+            if fetched is not None:
+                os.utime(filename, (time.time(), fetched))
+            logger.debug("wrote file: %s", filename)
+        finally:
+            if os.path.exists(tmp_filename):
+                os.remove(tmp_filename)
+
+    def get_many(self, api, method, region, max_age=None):
+        ''' Get {key: (fetched, records)} for all the queries of an api, method and region '''
+        found = []
+        now = time.time()
+        for _, _, _, key, filename in self.entries(api, method, region):
+            if is_pages_key(key):
+                continue
+            try:
+                stat = os.stat(filename)
+            except OSError:
+                continue
+            if max_age is None or now - stat.st_mtime <= max_age:
+                found.append((key, filename, stat))
+
+        results = {}
+        size = 0
+        decoded = decode_in_parallel(read_json_files, [filename for _, filename, _ in found])
+        for (key, filename, stat), (ok, records) in zip(found, decoded):
+            if ok:
+                results[key] = (stat.st_mtime, records)
+                size += stat.st_size
+                self.touch(filename, stat.st_mtime)
+        logger.debug("read %d files: %s-%s-%s-*", len(results), api, method, region)
+
+        run_metrics.add_query(api, method, region, cache_read_bytes=size)
+        return results
+
+    def put(self, api, method, region, key, records, fetched=None):
+        ''' Save the records for a query '''
+        filename = self.filename(api, method, region, key)
+        write_json_file(filename, records)
+        if fetched is not None:
+            os.utime(filename, (time.time(), fetched))
+        run_metrics.add_query(api, method, region, cache_written_bytes=os.path.getsize(filename))
+
+    def export(self):
+        '''
+        Yield (api, method, region, key, fetched, records) for every entry,
+        records being a list of pages for those cached a page at a time
+        '''
+        for api, method, region, key, filename in self.entries():
+            if is_pages_key(key):
+                result = self.get_pages(api, method, region, key)
+                if result is not None:
+                    yield api, method, region, key, result[0], list(result[1])
+                continue
+
+            result = self.read(filename)
+            if result is not None:
+                yield (api, method, region, key) + result
+
+    def flush(self, api=None, method=None, region=None):
+        ''' Remove matching entries, returning the number removed '''
+        removed = 0
+        for entry in self.entries(api, method, region):
+            try:
+                os.remove(entry[-1])
+                removed += 1
+            except OSError:
+                pass
+
+        return removed
+
+    def prune(self, max_bytes):
+        ''' Evict the least recently used entries until the cache fits in max_bytes '''
+        files = []
+        for entry in self.entries():
+            try:
+                stat = os.stat(entry[-1])
+            except OSError:
+                continue
+            files.append((stat.st_atime, stat.st_size, entry[-1]))
+
+        total = sum(size for _, size, _ in files)
+        removed = 0
+        for _, size, filename in sorted(files):
+            if total <= max_bytes:
+                break
+            try:
+                os.remove(filename)
+                total -= size
+                removed += 1
+            except OSError:
+                pass
+
+        return removed, total
+
+    def close(self):
+        ''' Nothing to close for files '''
+
+
+class SqliteCache:
+    '''
+    Cache store keeping every query result in a single SQLite database.
+    Payloads are zlib compressed JSON, with the time each was fetched and
+    last used. Each thread gets its own connection.
+    Results cached a page at a time keep their pages in the pages table, with
+    a row in the cache table, written last, marking them complete.
+    A read only cache leaves the last used times alone.
+    '''
+
+    def __init__(self, filename, read_only=False):
+        self.filename = filename
+        self.read_only = read_only
+        make_dirs(os.path.dirname(filename) or '.')
+        self.local = threading.local()
+        with self.connection() as conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS cache (
+                    api TEXT NOT NULL,
+                    method TEXT NOT NULL,
+                    region TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    fetched REAL NOT NULL,
+                    used REAL NOT NULL,
+                    size INTEGER NOT NULL,
+                    payload BLOB NOT NULL,
+                    PRIMARY KEY (api, method, region, key)
+                )''')
+            conn.execute('CREATE INDEX IF NOT EXISTS cache_used ON cache (used)')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS pages (
+                    api TEXT NOT NULL,
+                    method TEXT NOT NULL,
+                    region TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    page INTEGER NOT NULL,
+                    payload BLOB NOT NULL,
+                    PRIMARY KEY (api, method, region, key, page)
+                )''')
+
+    def connection(self):
+        ''' Get the connection for this thread '''
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.filename, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self.local.conn = conn
+        return conn
+
+    @staticmethod
+    def encode(records):
+        ''' Compress records into a payload '''
+        return zlib.compress(json.dumps(records, default=json_serial).encode())
+
+    @staticmethod
+    def decode(payload):
+        ''' Decompress a payload back into records '''
+        return json.loads(zlib.decompress(payload))
+
+    @staticmethod
+    def where(api=None, method=None, region=None):
+        ''' Build a where clause matching the given api, method and region '''
+        clauses = []
+        params = []
+        for column, value in (('api', api), ('method', method), ('region', region)):
+            if value:
+                clauses.append(column + ' = ?')
+                params.append(str(value))
+
+        return (' WHERE ' + ' AND '.join(clauses) if clauses else ''), params
+
+    def get(self, api, method, region, key, max_age=None):
+        ''' Get (fetched, records) for a query, or None if missing or too old '''
+        conn = self.connection()
+        row = conn.execute(
+            'SELECT fetched, payload FROM cache WHERE api = ? AND method = ? AND region = ? AND key = ?',
+            (api, method, str(region), key)
+        ).fetchone()
+        if row is None:
+            return None
+
+        fetched, payload = row
+        if max_age is not None and time.time() - fetched > max_age:
+            return None
+
+        if not self.read_only:
+            with conn:
+                conn.execute(
+                    'UPDATE cache SET used = ? WHERE api = ? AND method = ? AND region = ? AND key = ?',
+                    (time.time(), api, method, str(region), key)
+                )
+        logger.debug("read cache: %s %s %s %s", api, method, region, key)
+        run_metrics.add_query(api, method, region, cache_read_bytes=len(payload))
+        return fetched, self.decode(payload)
+
+    def get_pages(self, api, method, region, key, max_age=None):
+        '''
+        Get (fetched, pages) for a query cached a page at a time, where pages
+        reads the pages one at a time. None if missing or too old.
+        '''
+        result = self.get(api, method, region, key, max_age)
+        if result is None:
+            return None
+
+        return result[0], self.read_pages(api, method, region, key)
+
+    def read_pages(self, api, method, region, key):
+        ''' Read the pages for a query one at a time '''
+        rows = self.connection().execute(
+            'SELECT payload FROM pages WHERE api = ? AND method = ? AND region = ? AND key = ? ORDER BY page',
+            (api, method, str(region), key)
+        )
+        for (payload,) in rows:
+            run_metrics.add_query(api, method, region, cache_read_bytes=len(payload))
+            yield self.decode(payload)
+
+    def put_pages(self, api, method, region, key, pages, fetched=None):
+        '''
+        Save pages of records for a query as they pass through, yielding each
+        page on. They are written under a partial key and only replace any
+        existing pages once all pages are in.
+        '''
+        region = str(region)
+        partial = '{}.partial.{}'.format(key, threading.get_ident())
+        conn = self.connection()
+        count = 0
+        size = 0
+        try:
+            for page in pages:
+                payload = self.encode(page)
+                with conn:
+                    conn.execute(
+                        'INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?, ?)',
+                        (api, method, region, partial, count, payload)
+                    )
+                count += 1
+                size += len(payload)
+                yield page
+
+            now = time.time()
+            with conn:
+                conn.execute(
+                    'DELETE FROM pages WHERE api = ? AND method = ? AND region = ? AND key = ?',
+                    (api, method, region, key)
+                )
+                conn.execute(
+                    'UPDATE pages SET key = ? WHERE api = ? AND method = ? AND region = ? AND key = ?',
+                    (key, api, method, region, partial)
+                )
+                conn.execute(
+                    'INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                    (api, method, region, key, fetched or now, now, size,
+                     self.encode({'pages': count}))
+                )
+            logger.debug("wrote cache: %s %s %s %s", api, method, region, key)
+            run_metrics.add_query(api, method, region, cache_written_bytes=size)
+        finally:
+            with conn:
+                conn.execute(
+                    'DELETE FROM pages WHERE api = ? AND method = ? AND region = ? AND key = ?',
+                    (api, method, region, partial)
+                )
+
+    def get_many(self, api, method, region, max_age=None):
+        ''' Get {key: (fetched, records)} for all the queries of an api, method and region '''
+        where, params = self.where(api, method, region)
+        if max_age is not None:
+            where += ' AND fetched >= ?'
+            params.append(time.time() - max_age)
+
+        conn = self.connection()
+        rows = [
+            row for row in conn.execute('SELECT key, fetched, payload FROM cache' + where, params)
+            if not is_pages_key(row[0])
+        ]
+        if not self.read_only:
+            with conn:
+                conn.execute('UPDATE cache SET used = ?' + where, [time.time()] + params)
+
+        run_metrics.add_query(api, method, region, cache_read_bytes=sum(len(row[2]) for row in rows))
+        decoded = decode_in_parallel(decode_payloads, [payload for _, _, payload in rows])
+        return {
+            key: (fetched, records)
+            for (key, fetched, _), records in zip(rows, decoded)
+        }
+
+    def put(self, api, method, region, key, records, fetched=None):
+        ''' Save the records for a query '''
+        payload = self.encode(records)
+        now = time.time()
+        conn = self.connection()
+        with conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (api, method, str(region), key, fetched or now, now, len(payload), payload)
+            )
+        logger.debug("wrote cache: %s %s %s %s", api, method, region, key)
+        run_metrics.add_query(api, method, region, cache_written_bytes=len(payload))
+
+    def export(self):
+        '''
+        Yield (api, method, region, key, fetched, records) for every entry,
+        records being a list of pages for those cached a page at a time
+        '''
+        rows = self.connection().execute(
+            'SELECT api, method, region, key, fetched, payload FROM cache'
+        ).fetchall()
+        for api, method, region, key, fetched, payload in rows:
+            if is_pages_key(key):
+                yield api, method, region, key, fetched, list(self.read_pages(api, method, region, key))
+            else:
+                yield api, method, region, key, fetched, self.decode(payload)
+
+    def flush(self, api=None, method=None, region=None):
+        ''' Remove matching entries, returning the number removed '''
+        where, params = self.where(api, method, region)
+        conn = self.connection()
+        with conn:
+            conn.execute('DELETE FROM pages' + where, params)
+            return conn.execute('DELETE FROM cache' + where, params).rowcount
+
+    def prune(self, max_bytes):
+        ''' Evict the least recently used entries until the cache fits in max_bytes '''
+        conn = self.connection()
+        total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM cache').fetchone()[0]
+        if total <= max_bytes:
+            return 0, total
+
+        evict = []
+        rows = conn.execute('SELECT api, method, region, key, size FROM cache ORDER BY used').fetchall()
+        for api, method, region, key, size in rows:
+            if total <= max_bytes:
+                break
+            evict.append((api, method, region, key))
+            total -= size
+
+        with conn:
+            conn.executemany(
+                'DELETE FROM cache WHERE api = ? AND method = ? AND region = ? AND key = ?', evict
+            )
+            conn.executemany(
+                'DELETE FROM pages WHERE api = ? AND method = ? AND region = ? AND key = ?', evict
+            )
+
+        return len(evict), total
+
+    def close(self):
+        ''' Close the connection for this thread '''
+        conn = getattr(self.local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self.local.conn = None
+
+
+def read_json_files(filenames):
+    '''
+    Read JSON files, returning (True, obj), or (False, None) for any that
+    can't be read. Doesn't log, it can run in another process.
+    '''
+    results = []
+    for filename in filenames:
+        try:
+            with open(filename, 'r') as file:
+                results.append((True, json.loads(file.read())))
+        except (IOError, ValueError):
+            results.append((False, None))
+    return results
+
+
+def decode_payloads(payloads):
+    ''' Decode SQLite cache payloads '''
+    return [SqliteCache.decode(payload) for payload in payloads]
+
+
+def decode_in_parallel(decode, items):
+    '''
+    Decode cached results in bulk with decode(items) -> results. With enough
+    of them the items are decoded in chunks on a pool of processes, as
+    decoding JSON holds the GIL so threads would not help.
+    '''
+    global decode_pool
+    if decode_workers <= 1 or len(items) < decode_min_chunks * decode_chunk_size:
+        return decode(items)
+
+    with decode_pool_lock:
+        if decode_pool is None:
+            # spawn rather than fork, collectors are running on other threads
+            decode_pool = ProcessPoolExecutor(
+                max_workers=decode_workers,
+                mp_context=multiprocessing.get_context('spawn')
+            )
+
+    chunks = [items[start:start + decode_chunk_size] for start in range(0, len(items), decode_chunk_size)]
+    return [result for results in decode_pool.map(decode, chunks) for result in results]
+
+
+def close_decode_pool():
+    ''' Stop the decoding processes, if any were started '''
+    global decode_pool
+    with decode_pool_lock:
+        if decode_pool is not None:
+            decode_pool.shutdown()
+            decode_pool = None
+
+
+def get_cache():
+    ''' Get the cache store, a directory of JSON files unless set otherwise '''
+    global cache_store
+    if cache_store is None:
+        cache_store = FileCache(cache_dir, read_only=offline)
+    return cache_store
+
+
+def open_cache(backend):
+    ''' Open the cache store for a backend, files or sqlite, read only when offline '''
+    if backend == 'sqlite':
+        return SqliteCache(os.path.join(cache_dir, 'cache.sqlite'), read_only=offline)
+    return FileCache(cache_dir, read_only=offline)
+
+
+def migrate_cache(source, target):
+    ''' Copy every entry from one cache store into another, keeping fetch times '''
+    copied = 0
+    for api, method, region, key, fetched, records in source.export():
+        if is_pages_key(key):
+            for _ in target.put_pages(api, method, region, key, records, fetched=fetched):
+                pass
+        else:
+            target.put(api, method, region, key, records, fetched=fetched)
+        copied += 1
+
+    logger.info('migrated %d cache entries', copied)
+    return copied
+
+
+def flush_cache(api=None, method=None, region=None):
+    '''
+    Remove cached results, optionally only those for an api, method and/or region
+    Returns the number of results removed
+    '''
+    with memo_lock:
+        memo.clear()
+
+    removed = get_cache().flush(api, method, region)
+
+    logger.info('flushed %d cached results for api=%s method=%s region=%s',
+                removed, api or '*', method or '*', region or '*')
+    return removed
+
+
+def prune_cache(max_bytes):
+    '''
+    Evict the least recently used cached results until the cache fits in max_bytes
+    Returns the number of results removed
+    '''
+    removed, total = get_cache().prune(max_bytes)
+
+    if removed:
+        logger.info('evicted %d cached results, cache is now %d bytes', removed, total)
+    return removed
+
+
+def preload_cached(api, method, region):
+    '''
+    Load all the fresh cached results for an api, method and region with one
+    bulk lookup, ahead of querying them one by one. Returns {key: (fetched,
+    records)} to pass to query_aws as preloaded. They are not put in the
+    memo, where a few thousand of them would evict each other.
+    '''
+    return get_cache().get_many(api, method, region, max_age=cache_ttl(api))
+
+
+def memo_get(key, api):
+    ''' Get fresh records from the in-memory memo, or memo_missing '''
+    with memo_lock:
+        entry = memo.get(key)
+        if entry is None:
+            return memo_missing
+
+        fetched, records = entry
+        ttl = cache_ttl(api)
+        if ttl is not None and time.time() - fetched > ttl:
+            del memo[key]
+            return memo_missing
+
+        memo.move_to_end(key)
+        return records
+
+
+def memo_put(key, fetched, records):
+    ''' Add records to the in-memory memo, dropping the least recently used '''
+    with memo_lock:
+        memo[key] = (fetched, records)
+        memo.move_to_end(key)
+        while len(memo) > memo_size:
+            memo.popitem(last=False)
+
+
+def fetch_aws(api, method, region, kwargs):
+    ''' Call the AWS API and return all the records '''
     # connect to AWS and grab the data
-    client = boto3.client(api, region_name=region)
+    client = get_client(api, region)
     if api == 's3' and method == 'list_buckets':
         # s3 list_buckets has no paginator. :/
         records = client.list_buckets().get('Buckets', [])
@@ -149,6 +1162,8 @@ def query_aws(api, method, region, cached=True, **kwargs):
         if records is None:
             records = "us-east-1"
     elif api == 's3' and method == 'get_bucket_website':
+        import botocore.exceptions
+
         # s3 list_buckets has no paginator. :/
         try:
             records = client.get_bucket_website(Bucket=kwargs['Bucket'])
@@ -164,6 +1179,10 @@ def query_aws(api, method, region, cached=True, **kwargs):
     elif api == 'opensearch' and method == 'describe_domains':
         # opensearch describe_domains has no paginator. :/
         records = client.describe_domains(DomainNames=kwargs['DomainNames']).get('DomainStatusList', [])
+    elif api == 'sts' and method == 'get_caller_identity':
+        # sts get_caller_identity has no paginator
+        records = client.get_caller_identity()
+        records.pop('ResponseMetadata', None)
     elif api == 'elbv2' and method == 'describe_target_health':
         # elbv2 describe_target_health has no paginator. :/
         records = client.describe_target_health(TargetGroupArn=kwargs['TargetGroupArn'])
@@ -173,61 +1192,276 @@ def query_aws(api, method, region, cached=True, **kwargs):
         # get all records as we might overflow maxitems
         records = paginator.paginate(**kwargs).build_full_result()
 
-    write_json_file(filename, records)
-
     return records
 
 
-def check_external_service(dns_name):
+def load_aws(key, cached, kwargs):
     '''
-    Checks for known external services
+    Load records from the cache if fresh, otherwise fetch them from AWS
+    and save them in the cache. Returns the time fetched and the records.
     '''
+    api, method, region, _ = key
 
-    #TODO: Make this is a proper dictionary lookup.
-    if dns_name.endswith('pardot.com'):
-        return "pardot.com"
-    if dns_name.endswith('zendesk.com'):
-        return "Zendesk.com"
+    # look for a fresh cached result, return it if found
+    if cached:
+        result = get_cache().get(*key, max_age=cache_ttl(api))
+        if result is not None:
+            run_metrics.add_query(api, method, region, cache_hits=1)
+            return result
+        run_metrics.add_query(api, method, region, cache_misses=1)
 
-    # Certs
-    if dns_name.endswith('acm-validations.aws'):
-        return "AWS Certs"
-    if dns_name.endswith('comodoca.com'):
-        return "Comodo CA"
-    if dns_name.endswith('sectigo.com'):
-        return "Sectigo CA"
+    if offline:
+        raise CacheMissError(api, method, region, kwargs)
 
-    # Google
-    if dns_name.endswith('ghs.google.com'):
-        return "Google Hosted"
-    if dns_name.endswith('googlehosted.com'):
-        return "Google Hosted"
+    start = time.perf_counter()
+    try:
+        records = fetch_aws(api, method, region, kwargs)
+    except Exception:
+        run_metrics.add_query(api, method, region, errors=1)
+        raise
+    finally:
+        run_metrics.add_query(api, method, region, fetches=1, fetch_seconds=time.perf_counter() - start)
+    get_cache().put(*key, records)
+
+    return time.time(), records
+
+
+def records_digest(records):
+    ''' Hash query records so changes to them can be spotted '''
+    return sha1(
+        json.dumps(records, sort_keys=True, separators=(',', ':'), default=json_serial).encode()
+    ).hexdigest()
+
+
+def calls_fingerprint(calls):
+    ''' Hash a list of recorded calls, with their records digests, in any order '''
+    return sha1(
+        json.dumps(
+            sorted(
+                [api, method, str(region), cached, cache_key(kwargs), digest, streamed]
+                for api, method, region, cached, kwargs, digest, streamed in calls
+            ),
+            separators=(',', ':')
+        ).encode()
+    ).hexdigest()
+
+
+@contextmanager
+def recording(calls=None, fetched=None):
+    '''
+    Record the queries made on this thread into a list of
+    [api, method, region, cached, kwargs, records digest, streamed].
+    Uncached queries are answered from fetched, {query key: records}, once
+    each, rather than going to AWS again.
+    '''
+    previous = getattr(recorder, 'calls', None), getattr(recorder, 'fetched', None)
+    recorder.calls = [] if calls is None else calls
+    recorder.fetched = fetched
+    try:
+        yield recorder.calls
+    finally:
+        recorder.calls, recorder.fetched = previous
 
 
-    if dns_name.endswith('dkim.amazonses.com'):
-        return "dkim.amazonses.com"
+def record_call(api, method, region, cached, kwargs, digest, streamed=False):
+    ''' Record a query if the current thread is recording '''
+    calls = getattr(recorder, 'calls', None)
+    if calls is not None:
+        calls.append([api, method, region, cached, kwargs, digest, streamed])
 
-    if dns_name.endswith('azurewebsites.net'):
-        return "azurewebsites.net"
-    
-    if dns_name.endswith('stspg-customer.com'):
-        return "Status Page"
 
+def fan_out(func, items, workers=None):
+    '''
+    Call func for each item on a bounded pool of threads, returning the
+    results in the same order as the items. Queries made by func are
+    recorded against the calling thread, see recording().
+    '''
+    items = list(items)
+    workers = workers or fan_out_workers
+    if workers <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+
+    calls = getattr(recorder, 'calls', None)
+    fetched = getattr(recorder, 'fetched', None)
+
+    def call(item):
+        recorder.calls = calls
+        recorder.fetched = fetched
+        try:
+            return func(item)
+        finally:
+            recorder.calls = recorder.fetched = None
+
+    with ThreadPoolExecutor(max_workers=min(workers, len(items))) as executor:
+        return list(executor.map(call, items))
 
 
+def fetch_aws_pages(api, method, region, kwargs):
+    ''' Call a paginated AWS API, yielding one page of records at a time '''
+    paginator = get_client(api, region).get_paginator(method)
+    page_iterator = paginator.paginate(**kwargs)
 
-    return None
+    # Keep just the records, pagination tokens and request ids change every call
+    result_keys = [
+        result_key.expression
+        for result_key in getattr(page_iterator, 'result_keys', None) or []
+    ]
+    if any('.' in result_key for result_key in result_keys):
+        result_keys = []
+
+    for page in page_iterator:
+        if result_keys:
+            page = {result_key: page.get(result_key, []) for result_key in result_keys}
+        else:
+            page.pop('ResponseMetadata', None)
+        yield page
+
+
+def query_aws_pages(api, method, region, cached=True, **kwargs):
+    '''
+    Query a paginated AWS API, yielding one page of records at a time so only
+    a page is held in memory and processing overlaps fetching.
+    Pages are cached as they stream in and read back a page at a time,
+    with the same expiry as query_aws. They are not kept in the memo.
+    '''
+    key = (api, method, region, pages_prefix + cache_key(kwargs))
+    start = time.perf_counter()
+    cached = cached or offline
+
+    result = get_cache().get_pages(*key, max_age=cache_ttl(api)) if cached else None
+    if result is not None:
+        pages = result[1]
+        counts = {'cache_hits': 1}
+    elif offline:
+        run_metrics.add_query(api, method, region, cache_misses=1)
+        raise CacheMissError(api, method, region, kwargs)
+    else:
+        pages = get_cache().put_pages(*key, fetch_aws_pages(api, method, region, kwargs))
+        counts = {'cache_misses': int(cached), 'fetches': 1}
+
+    # time reading the pages, not what the caller does with each one
+    seconds = time.perf_counter() - start
+    count = 0
+    recording_calls = getattr(recorder, 'calls', None) is not None
+    digest = sha1()
+    pages = iter(pages)
+    try:
+        while True:
+            start = time.perf_counter()
+            page = next(pages, None)
+            seconds += time.perf_counter() - start
+            if page is None:
+                break
+            count += 1
+            if recording_calls:
+                digest.update(records_digest(page).encode())
+            yield page
+    except Exception:
+        counts['errors'] = 1
+        raise
+    finally:
+        if 'fetches' in counts:
+            counts['fetch_seconds'] = seconds
+        run_metrics.add_query(api, method, region, queries=1, seconds=seconds, pages=count, **counts)
+
+    if recording_calls:
+        record_call(api, method, region, cached, kwargs, digest.hexdigest(), streamed=True)
+
+
+def lookup_aws(key, cached, kwargs):
+    '''
+    Look up the records for a query in the memo, or load them. Identical
+    queries made at the same time share a single load.
+    '''
+    api = key[0]
+
+    if cached:
+        records = memo_get(key, api)
+        if records is not memo_missing:
+            run_metrics.add_query(*key[:3], memo_hits=1)
+            return records
+
+    # Join a matching query that is already running, or become the one running it
+    flight_key = key + (cached,)
+    with inflight_lock:
+        future = inflight.get(flight_key)
+        owner = future is None
+        if owner:
+            future = inflight[flight_key] = Future()
+
+    if not owner:
+        # shares the owner's load, so counts as a memo hit
+        run_metrics.add_query(*key[:3], memo_hits=1)
+        return future.result()
+
+    try:
+        fetched, records = load_aws(key, cached, kwargs)
+        memo_put(key, fetched, records)
+        future.set_result(records)
+    except Exception as error:
+        future.set_exception(error)
+        raise
+    finally:
+        with inflight_lock:
+            del inflight[flight_key]
+
+    return records
+
+
+def query_aws(api, method, region, cached=True, preloaded=None, **kwargs):
+    '''
+    Query AWS API using api and method to call for a given region
+    Cache the results to the filesystem for faster re-run. Cached results
+    expire after the ttl for the api, see cache_ttls.
+    Results are also kept in memory for the rest of the run, and identical
+    queries made at the same time share a single call to AWS.
+    preloaded holds cached results already read by preload_cached.
+    '''
+    start = time.perf_counter()
+    # uncached queries were still saved to the cache, use them when offline
+    cached = cached or offline
+    key = (api, method, region, cache_key(kwargs))
+    fetched = None if cached else getattr(recorder, 'fetched', None)
+    if cached and preloaded and key[3] in preloaded:
+        records = preloaded[key[3]][1]
+        run_metrics.add_query(api, method, region, cache_hits=1)
+    elif fetched and key in fetched:
+        # fetched moments ago while checking whether the unit had changed
+        records = fetched.pop(key)
+        run_metrics.add_query(api, method, region, memo_hits=1)
+    else:
+        records = lookup_aws(key, cached, kwargs)
+    run_metrics.add_query(api, method, region, queries=1, seconds=time.perf_counter() - start)
+    if getattr(recorder, 'calls', None) is not None:
+        record_call(api, method, region, cached, kwargs, records_digest(records))
+
+    return records
+
+
+def get_external_services():
+    ''' Get the external services classifier, loading it the first time '''
+    global external_services
+    if external_services is None:
+        external_services = load_services(external_services_file)
+    return external_services
+
+
+def check_external_service(dns_name):
+    '''
+    Checks for known external services, returning the service name or None
+    '''
+    return get_external_services().classify(dns_name)
 
 
 def process_dns_records(zone_id, region, nodes, edges):
     """
     Find nodes and edges in the DNS records
     """
-    # get records for zone_id and region
-    records = query_aws('route53', 'list_resource_record_sets', region,
-                        HostedZoneId=zone_id).get('ResourceRecordSets', [])
+    # get records for zone_id and region, a page at a time
+    pages = query_aws_pages('route53', 'list_resource_record_sets', region,
+                            HostedZoneId=zone_id)
 
-    for record in records:
+    for record in (record for page in pages for record in page.get('ResourceRecordSets', [])):
         name = fmt_dns(record['Name'])
         ns_type = record['Type']
         ns_value = fmt_dns(
@@ -253,7 +1487,8 @@ def process_dns_records(zone_id, region, nodes, edges):
             # Clamp dns weights to 1 or 0
             weight = 1 if record.get('Weight', 1) > 0 else 0
             # add the edge value for the CNAME
-            edges.append(
+            add_update_edge(
+                edges,
                 new_edge(
                     from_type='dns',
                     from_name=name,
@@ -286,7 +1521,8 @@ def process_dns_records(zone_id, region, nodes, edges):
                         description=external_service_name
                     )
                 )
-                edges.append(
+                add_update_edge(
+                    edges,
                     new_edge(
                         from_type='dns',
                         from_name=ns_value,
@@ -348,7 +1584,8 @@ def process_cloudfront(region, nodes, edges):
         )
 
         # add an edge for the DNS cloudfront
-        edges.append(
+        add_update_edge(
+            edges,
             new_edge(
                 from_type='dns',
                 from_name=fmt_dns(instance['DomainName']),
@@ -361,7 +1598,8 @@ def process_cloudfront(region, nodes, edges):
 
         # Loop through each of the origins and link them to endpoints
         for origin in instance['Origins']['Items']:
-            edges.append(
+            add_update_edge(
+                edges,
                 new_edge(
                     from_type='cloudfront',
                     from_name=fmt_dns(instance['DomainName']),
@@ -377,8 +1615,8 @@ def process_ec2s(region, nodes, edges):
     """
     Find all the EC2 instances in the given region
     """
-    # we're only interested in running instances
-    records = query_aws(
+    # we're only interested in running instances, read a page at a time
+    pages = query_aws_pages(
         'ec2',
         'describe_instances',
         region,
@@ -386,9 +1624,8 @@ def process_ec2s(region, nodes, edges):
             {'Name': 'instance-state-name', 'Values': ['running']}
         ]
     )
-    records = records.get('Reservations', [])
 
-    for resv in records:
+    for resv in (resv for page in pages for resv in page.get('Reservations', [])):
         for instance in resv.get('Instances'):
             # get instances takes into a dict
             inst_tags = {t['Key']: t['Value'] for t in instance.get('Tags')}
@@ -424,7 +1661,8 @@ def process_ec2s(region, nodes, edges):
             # )
 
             # # add the private ip edge
-            # edges.append(
+            # add_update_edge(
+            #     edges,
             #     new_edge(
             #         from_type='ec2',
             #         from_name=instance['InstanceId'],
@@ -447,7 +1685,8 @@ def process_ec2s(region, nodes, edges):
                     )
                 )
                 # add the public ip edge
-                edges.append(
+                add_update_edge(
+                    edges,
                     new_edge(
                         from_type='ec2',
                         from_name=instance['InstanceId'],
@@ -479,7 +1718,8 @@ def process_elbs(region, nodes, edges):
         )
         # Add Edges - of dependent instances
         for instances in elb['Instances']:
-            edges.append(
+            add_update_edge(
+                edges,
                 new_edge(
                     from_type='elb',
                     from_name=name,
@@ -496,6 +1736,36 @@ def process_elbsv2(region, nodes, edges):
     """
     records = query_aws('elbv2', 'describe_load_balancers', region, cached=False)
 
+    # Get every target group in the region in one go and group them by ELB.
+    # Live like the load balancers, or a new one would have none until the
+    # cached list expired
+    target_groups = query_aws('elbv2', 'describe_target_groups', region, cached=False)
+
+    elb_arns = set(elb['LoadBalancerArn'] for elb in records['LoadBalancers'])
+    elb_target_groups = {}
+    for target_group in target_groups['TargetGroups']:
+        for elb_arn in target_group.get('LoadBalancerArns', []):
+            if elb_arn in elb_arns:
+                elb_target_groups.setdefault(elb_arn, []).append(target_group)
+
+    # Load the cached target health lookups in bulk rather than one at a time
+    cached_healths = preload_cached('elbv2', 'describe_target_health', region)
+
+    # Then look up the health of the target groups in use in parallel
+    target_group_arns = sorted(set(
+        target_group['TargetGroupArn']
+        for elb_groups in elb_target_groups.values()
+        for target_group in elb_groups
+    ))
+    target_healths = dict(zip(
+        target_group_arns,
+        fan_out(
+            lambda arn: query_aws('elbv2', 'describe_target_health', region,
+                                  preloaded=cached_healths, TargetGroupArn=arn),
+            target_group_arns
+        )
+    ))
+
     for elb in records['LoadBalancers']:
         name = fmt_dns(elb['DNSName'])
 
@@ -518,7 +1788,8 @@ def process_elbsv2(region, nodes, edges):
             )
         )
         # add an edge for the RDS to DNS link
-        edges.append(
+        add_update_edge(
+            edges,
             new_edge(
                 from_type='dns',
                 from_name=fmt_dns(elb['DNSName']),
@@ -529,23 +1800,12 @@ def process_elbsv2(region, nodes, edges):
             )
         )
 
-        # TODO - this can likely come out to it's own top level
-        target_groups  = query_aws('elbv2',
-                                    'describe_target_groups',
-                                    region,
-                                    LoadBalancerArn=elb['LoadBalancerArn']
-                                    )
-
-        for target_group in target_groups['TargetGroups']:
+        for target_group in elb_target_groups.get(elb['LoadBalancerArn'], []):
             # Loop over each target
-            target_healths = query_aws('elbv2',
-                                    'describe_target_health',
-                                    region,
-                                    TargetGroupArn=target_group['TargetGroupArn']
-                                    )
-            for target in target_healths['TargetHealthDescriptions']:
+            for target in target_healths[target_group['TargetGroupArn']]['TargetHealthDescriptions']:
                 # Connect ELB to the target instance
-                edges.append(
+                add_update_edge(
+                    edges,
                     new_edge(
                         from_type='ec2',
                         from_name=target['Target']['Id'],
@@ -595,7 +1855,8 @@ def process_rds(region, nodes, edges):
             )
         )
         # add an edge for the RDS to DNS link
-        edges.append(
+        add_update_edge(
+            edges,
             new_edge(
                 from_type='dns',
                 from_name=dnsname,
@@ -613,7 +1874,8 @@ def process_rds(region, nodes, edges):
                 account_id = get_aws_account_id()
                 replica_source = f"arn:aws:rds:{region}:{account_id}:db:{replica_source}"
 
-            edges.append(
+            add_update_edge(
+                edges,
                 new_edge(
                     from_type='rds',
                     from_name=replica_source,
@@ -648,7 +1910,8 @@ def process_asgs(region, nodes, edges):
         )
         # connect any ELBs
         for elb in asg.get('LoadBalancerNames', []):
-            edges.append(
+            add_update_edge(
+                edges,
                 new_edge(
                     from_type='asg',
                     from_name=name,
@@ -661,7 +1924,8 @@ def process_asgs(region, nodes, edges):
         # connect instances
         # Add Edges - of dependent instances
         for ec2 in asg.get('Instances', []):
-            edges.append(
+            add_update_edge(
+                edges,
                 new_edge(
                     from_type='ec2',
                     from_name=ec2.get('InstanceId'),
@@ -708,7 +1972,8 @@ def process_redshift(region, nodes, edges):
             )
         )
         # add an edge for the RDS to DNS link
-        edges.append(
+        add_update_edge(
+            edges,
             new_edge(
                 from_type='dns',
                 from_name=name,
@@ -771,7 +2036,8 @@ def process_elasticache(region, nodes, edges):
                 )
             )
             # add an edge for the RDS to DNS link
-            edges.append(
+            add_update_edge(
+                edges,
                 new_edge(
                     from_type='dns',
                     from_name=endpoint,
@@ -817,7 +2083,7 @@ def process_opensearch(region, nodes, edges):
 
     domain_names = []
     for record in records:
-        print(record)
+        logger.debug('  - %s', record['DomainName'])
         domain_names.append(record['DomainName'])
 
     # Get the domain details
@@ -861,7 +2127,8 @@ def process_opensearch(region, nodes, edges):
             )
         )
         # add an edge for the Cluster to DNS link
-        edges.append(
+        add_update_edge(
+            edges,
             new_edge(
                 from_type='dns',
                 from_name=endpoint,
@@ -884,19 +2151,32 @@ def process_s3(region, nodes, edges):
         region
     )
 
-    for bucket in records:
-        # logger.info('*****&* {}'.format(region))
+    # Load the cached per bucket lookups in bulk rather than one at a time
+    cached_locations = preload_cached('s3', 'get_bucket_location', region)
+    cached_websites = preload_cached('s3', 'get_bucket_website', region)
 
-        #Get the bucket location
+    def lookup_bucket(bucket):
+        ''' Get the location and website configuration of a bucket '''
         bucket_region = query_aws(
             's3',
             'get_bucket_location',
             region,
+            preloaded=cached_locations,
             Bucket=bucket['Name']
         )
+        bucket_website = query_aws(
+            's3',
+            'get_bucket_website',
+            region,
+            preloaded=cached_websites,
+            Bucket=bucket['Name']
+        )
+        return bucket_region, bucket_website
 
+    # Look up all the buckets in parallel
+    lookups = fan_out(lookup_bucket, records)
 
-
+    for bucket, (bucket_region, bucket_website) in zip(records, lookups):
         #Add the node or the S3 Domain
         add_update_node(
             nodes,
@@ -937,7 +2217,8 @@ def process_s3(region, nodes, edges):
                 )
             )
             # add an edge for the RDS to DNS link
-            edges.append(
+            add_update_edge(
+                edges,
                 new_edge(
                     from_type='dns',
                     from_name=full_bucket_name,
@@ -949,45 +2230,8 @@ def process_s3(region, nodes, edges):
             )
 
         # Check if the is a website configuration for this - if so then link it in
-        bucket_website = query_aws(
-            's3',
-            'get_bucket_website',
-            region,
-            Bucket=bucket['Name']
-        )
-        
         if bucket_website != {}:
 
-            # S3 Website domain names from here:
-            # https://docs.aws.amazon.com/general/latest/gr/s3.html#s3_website_region_endpoints
-            s3_website_regions = {
-                "us-east-1": "s3-website-us-east-1.amazonaws.com",
-                "us-east-2": "s3-website.us-east-1.amazonaws.com",
-                "us-west-1": "s3-website-us-west-1.amazonaws.com",
-                "us-west-2": "s3-website-us-west-2.amazonaws.com",
-                "us-east-1": "s3-website-us-east-1.amazonaws.com",
-                "af-south-1":"s3-website.af-south-1.amazonaws.com",
-                "ap-east-1":"s3-website.ap-east-1.amazonaws.com",
-                "ap-south-1":"s3-website.ap-south-1.amazonaws.com",
-                "ap-northeast-3":"s3-website.ap-northeast-3.amazonaws.com",
-                "ap-northeast-2":"s3-website.ap-northeast-2.amazonaws.com",
-                "ap-southeast-1":"s3-website-ap-southeast-1.amazonaws.com",
-                "ap-southeast-2":"s3-website-ap-southeast-2.amazonaws.com",
-                "ap-northeast-1":"s3-website-ap-northeast-1.amazonaws.com",
-                "ca-central-1":"s3-website.ca-central-1.amazonaws.com",
-                "cn-northwest-1.amazonaws.com.cn":"s3-website.cn-northwest-1.amazonaws.com.cn",
-                "eu-central-1":"s3-website.eu-central-1.amazonaws.com",
-                "eu-west-1":"s3-website-eu-west-1.amazonaws.com",
-                "eu-west-2":"s3-website.eu-west-2.amazonaws.com",
-                "eu-south-1":"s3-website.eu-south-1.amazonaws.com",
-                "eu-west-3":"s3-website.eu-west-3.amazonaws.com",
-                "eu-north-1":"s3-website.eu-north-1.amazonaws.com",
-                "me-south-1":"s3-website.me-south-1.amazonaws.com",
-                "sa-east-1":"s3-website-sa-east-1.amazonaws.com",
-                "us-gov-east-1":"s3-website.us-gov-east-1.amazonaws.com",
-                "us-gov-west-1":"s3-website-us-gov-west-1.amazonaws.com",
-            }
-
             s3_website_host = f"{bucket['Name']}.{s3_website_regions.get(bucket_region,'UNKNOWN_REGION')}"
 
             # Add the DNS node for it
@@ -1001,7 +2245,8 @@ def process_s3(region, nodes, edges):
                 )
             )
             # add an edge for the RDS to DNS link
-            edges.append(
+            add_update_edge(
+                edges,
                 new_edge(
                     from_type='dns',
                     from_name=s3_website_host,
@@ -1020,28 +2265,29 @@ def process_s3(region, nodes, edges):
 
 
 
-def main():
-    ''' Main function to kick it all off '''
-
-    nodes = {}
-    edges = []
-
-    # TODO: This should come from config file
-
-    region_list = [
-        'us-west-1', 'us-west-2', 'us-east-1', 'eu-west-1', 'ap-southeast-2'
-        # 'us-west-1'
+def region_collectors():
+    ''' Collectors run once for each region in the region list '''
+    return [
+        process_ec2s,
+        process_elbs,
+        process_elbsv2,
+        process_rds,
+        process_redshift,
+        process_elasticache,
+        process_asgs,
+        process_sqs,
+        process_opensearch,
     ]
 
-    # used for "global" AWS services
-    region = 'us-east-1'
-
-    nodes_filename = 'data/nodes.csv'
-    edges_filename = 'data/edges.csv'
 
-    # Make dirs for storage
-    make_dirs('data')
-    make_dirs('cache')
+def build_units(region, region_list):
+    '''
+    Build the ordered list of collection units.
+    Each unit is a (name, collector) pair where collector(nodes, edges) adds
+    its own nodes and edges. The order matches a serial run so that merging
+    the results in this order gives the same output.
+    '''
+    units = []
 
     # -------------------------------------------------------------------------
     # Route53
@@ -1049,34 +2295,680 @@ def main():
     zones = query_aws('route53', 'list_hosted_zones', region)
 
     for zone in zones.get('HostedZones', []):
-        process_dns_records(zone['Id'], region, nodes, edges)
+        units.append(
+            ('route53 ' + zone['Id'], partial(process_dns_records, zone['Id'], region))
+        )
 
     # ---------------------------------------------------------------------
     # Global services - S3, Cloudfront
     # ---------------------------------------------------------------------
-    process_cloudfront(region, nodes, edges)
-    process_s3(region, nodes, edges)
+    units.append(('cloudfront', partial(process_cloudfront, region)))
+    units.append(('s3', partial(process_s3, region)))
 
     # -------------------------------------------------------------------------
     # Regions loop
     # -------------------------------------------------------------------------
-    for region in region_list:
-        logger.info('** %s', region)
-
-        process_ec2s(region, nodes, edges)
-        process_elbs(region, nodes, edges)
-        process_elbsv2(region, nodes, edges)
-        process_rds(region, nodes, edges)
-        process_redshift(region, nodes, edges)
-        process_elasticache(region, nodes, edges)
-        process_asgs(region, nodes, edges)
-        process_sqs(region, nodes, edges)
-        process_opensearch(region, nodes, edges)
-
-        # TODO: handle external DNS names - eg go.pardot.com etc.
-
-    write_csv(nodes.values(), nodes_filename, node_fields)
-    write_csv(edges, edges_filename, edge_fields)
+    for region_name in region_list:
+        for collector in region_collectors():
+            units.append(
+                (
+                    ' '.join([region_name, collector.__name__]),
+                    partial(collector, region_name)
+                )
+            )
+
+    # TODO: handle external DNS names - eg go.pardot.com etc.
+
+    return units
+
+
+def run_unit(name, collector):
+    ''' Run a single collection unit into its own local nodes and edges '''
+    logger.info('** %s', name)
+
+    nodes = {}
+    edges = {}
+    start = time.perf_counter()
+    collector(nodes, edges)
+    run_metrics.add_collector(*collector_labels(collector), runs=1, seconds=time.perf_counter() - start,
+                              nodes=len(nodes), edges=len(edges))
+
+    return nodes, edges
+
+
+def collector_labels(collector):
+    ''' The collector and region of a unit's collector, a partial with the region last '''
+    return collector.func.__name__, collector.args[-1]
+
+
+def merge_graph(nodes, edges, unit_nodes, unit_edges):
+    '''
+    Merge the nodes and edges of a unit into the main graph.
+    Duplicate nodes and edges add their counter (and edges their weight),
+    the same as add_update_node and add_update_edge would have done had they
+    been added one at a time.
+    '''
+    for node_name, node in unit_nodes.items():
+        if node_name in nodes:
+            nodes[node_name].counter += node.counter
+        else:
+            # copy so the unit's own node keeps its counter
+            nodes[node_name] = node.copy()
+
+    for key, edge in unit_edges.items():
+        if key in edges:
+            edges[key].counter += edge.counter
+            edges[key].weight += edge.weight
+        else:
+            edges[key] = edge.copy()
+
+
+def replay_fingerprint(calls, fetched=None):
+    '''
+    Make the recorded calls again and fingerprint the records they return now.
+    Returns None if any of them fail. The records of uncached queries are
+    put in fetched, so a unit that has changed can re-run without fetching
+    them again.
+    '''
+    try:
+        replayed = []
+        with recording(replayed):
+            for api, method, region, cached, kwargs, _, streamed in calls:
+                if streamed:
+                    for _ in query_aws_pages(api, method, region, cached, **kwargs):
+                        pass
+                else:
+                    records = query_aws(api, method, region, cached, **kwargs)
+                    if not cached and fetched is not None:
+                        fetched[(api, method, region, cache_key(kwargs))] = records
+    except Exception as error:
+        logger.debug('replay failed: %s', error)
+        return None
+
+    return calls_fingerprint(replayed)
+
+
+def unit_graph(entry):
+    ''' Rebuild the nodes and edges of a unit from its saved state '''
+    nodes = [Node(*row) for row in entry['nodes']]
+    edges = [Edge(*row) for row in entry['edges']]
+    return {node_key(node): node for node in nodes}, {edge_key(edge): edge for edge in edges}
+
+
+def run_unit_incremental(previous, current, name, collector):
+    '''
+    Run a collection unit, unless the queries it made last run still return
+    the same records, in which case its previous nodes and edges are reused.
+    The unit's state for next time is saved into current.
+    '''
+    entry = previous.get(name)
+    start = time.perf_counter()
+    fetched = {}
+    if entry is not None and replay_fingerprint(entry['calls'], fetched) == entry['fingerprint']:
+        logger.info('** %s unchanged', name)
+        current[name] = dict(entry, changed=False)
+        nodes, edges = unit_graph(entry)
+        run_metrics.add_collector(*collector_labels(collector), reused=1, seconds=time.perf_counter() - start,
+                                  nodes=len(nodes), edges=len(edges))
+        return nodes, edges
+
+    with recording(fetched=fetched) as calls:
+        nodes, edges = run_unit(name, collector)
+
+    current[name] = {
+        'calls': calls,
+        'fingerprint': calls_fingerprint(calls),
+        'nodes': [node.row() for node in nodes.values()],
+        'edges': [edge.row() for edge in edges.values()],
+        'changed': True,
+    }
+    return nodes, edges
+
+
+def collect_units(units, nodes, edges, workers=1, run=run_unit):
+    '''
+    Run all the collection units, using a pool of workers if more than one.
+    Results are merged in unit order so the output matches a serial run.
+    '''
+    if workers <= 1:
+        for name, collector in units:
+            merge_graph(nodes, edges, *run(name, collector))
+        return
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(run, name, collector)
+            for name, collector in units
+        ]
+        try:
+            for future in futures:
+                merge_graph(nodes, edges, *future.result())
+        except Exception:
+            # fail fast rather than running every other unit first
+            for future in futures:
+                future.cancel()
+            raise
+
+
+def read_state(filename):
+    ''' Read the saved incremental state, or an empty state if there is none '''
+    try:
+        with gzip.open(filename, 'rt') as file:
+            state = json.load(file)
+            logger.debug("read file: %s", filename)
+    except (IOError, ValueError):
+        return {'units': []}
+
+    if state.get('version') != state_version:
+        return {'units': []}
+    return state
+
+
+def write_state(filename, units, current):
+    ''' Save the incremental state of every unit, in unit order '''
+    state = {
+        'version': state_version,
+        'external_services': get_external_services().digest,
+        'units': [
+            dict(current[name], name=name, changed=None)
+            for name, _ in units
+            if name in current
+        ],
+    }
+
+    save_gzip_json(filename, state, default=json_serial)
+
+
+def state_graph(state):
+    ''' Rebuild the whole graph saved in a state '''
+    nodes = {}
+    edges = {}
+    for entry in state['units']:
+        merge_graph(nodes, edges, *unit_graph(entry))
+
+    return nodes, edges
+
+
+def graph_delta(old_nodes, old_edges, nodes, edges):
+    '''
+    Work out the nodes and edges added, removed or changed between two graphs.
+    '''
+    def diff(old, new):
+        return {
+            'added': [item.to_dict() for key, item in new.items() if key not in old],
+            'removed': [item.to_dict() for key, item in old.items() if key not in new],
+            'changed': [
+                item.to_dict() for key, item in new.items()
+                if key in old and old[key] != item
+            ],
+        }
+
+    return {
+        'nodes': diff(old_nodes, nodes),
+        'edges': diff(old_edges, edges),
+    }
+
+
+def write_delta(filename, delta, current):
+    ''' Save the graph delta with a summary of which units changed '''
+    delta = dict(
+        delta,
+        generated=datetime.utcnow(),
+        units={
+            'changed': sorted(name for name, entry in current.items() if entry['changed']),
+            'unchanged': sum(1 for entry in current.values() if not entry['changed']),
+        },
+    )
+    write_json_file(filename, delta)
+
+
+def build_graph(nodes, edges):
+    '''
+    Build the integer indexed graph of the collected nodes and edges,
+    reporting any edges that point at nodes that were not collected
+    '''
+    graph = Graph.build(nodes.values(), edges.values())
+    graph.count_reachable()
+
+    logger.info('graph: %d nodes, %d edges, %d dangling edges',
+                graph.node_count, graph.edge_count, len(graph.dangling))
+    for dangling in graph.dangling:
+        logger.debug('dangling edge, missing %s: %s -> %s',
+                     dangling['missing'], dangling['source'], dangling['target'])
+
+    return graph
+
+
+def parse_args(argv=None):
+    ''' Parse the command line options '''
+    parser = argparse.ArgumentParser(description='Collect AWS infrastructure dependencies')
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=max_workers,
+        help='Number of collectors to run at once, 1 to run serially (default: %(default)s)'
+    )
+    parser.add_argument(
+        '--fan-out-workers',
+        type=int,
+        default=fan_out_workers,
+        help='Number of per item lookups, eg target health or bucket location, '
+             'to run at once for each collector (default: %(default)s)'
+    )
+    parser.add_argument(
+        '--max-pool-connections',
+        type=int,
+        default=client_settings['max_pool_connections'],
+        help='Connections kept open per AWS client (default: %(default)s)'
+    )
+    parser.add_argument(
+        '--max-attempts',
+        type=int,
+        default=client_settings['max_attempts'],
+        help='Attempts per AWS call including retries (default: %(default)s)'
+    )
+    parser.add_argument(
+        '--retry-mode',
+        choices=['legacy', 'standard', 'adaptive'],
+        default=client_settings['retry_mode'],
+        help='botocore retry mode (default: %(default)s)'
+    )
+    parser.add_argument(
+        '--flush',
+        nargs='*',
+        metavar='API[:METHOD[:REGION]]',
+        help='Flush cached results before collecting, all of them if no '
+             'selector is given. eg: --flush ec2 elbv2:describe_target_health'
+    )
+    parser.add_argument(
+        '--flush-only',
+        action='store_true',
+        help='Exit after flushing the cache rather than collecting'
+    )
+    parser.add_argument(
+        '--ttl',
+        action='append',
+        type=parse_ttl,
+        default=[],
+        metavar='API=SECONDS',
+        help='Override how long cached results for an api stay fresh'
+    )
+    parser.add_argument(
+        '--cache-backend',
+        choices=['files', 'sqlite'],
+        default='files',
+        help='Cache each result as its own JSON file, or all in one SQLite '
+             'database (default: %(default)s)'
+    )
+    parser.add_argument(
+        '--migrate-cache',
+        action='store_true',
+        help='Copy the JSON files in the cache directory into the SQLite cache'
+    )
+    parser.add_argument(
+        '--incremental',
+        action='store_true',
+        help='Only re-process collectors whose AWS records changed since the '
+             'last incremental run, and write the changes to data/delta.json'
+    )
+    parser.add_argument(
+        '--offline',
+        action='store_true',
+        help='Rebuild everything from the cache alone, however old, without '
+             'AWS credentials. Stops at the first query that is not cached'
+    )
+    parser.add_argument(
+        '--decode-workers',
+        type=int,
+        default=decode_workers,
+        help='Processes decoding bulk cache reads, the S3 bucket and target '
+             'health lookups, 1 to decode them in this process (default: %(default)s)'
+    )
+    parser.add_argument(
+        '--cache-max-mb',
+        type=int,
+        default=cache_max_bytes // (1024 * 1024),
+        help='Evict least recently used cache files above this size, split evenly '
+             'between the accounts when collecting several (default: %(default)s)'
+    )
+    parser.add_argument(
+        '--no-layout',
+        action='store_true',
+        help='Skip laying out the graph, leaving it to the browser'
+    )
+    parser.add_argument(
+        '--external-services',
+        default=external_services_file,
+        metavar='FILE',
+        help='JSON file mapping external service names to their DNS suffixes '
+             '(default: %(default)s)'
+    )
+    parser.add_argument(
+        '--metrics-prometheus',
+        metavar='FILE',
+        help='Also write the run metrics in the Prometheus text format, eg for '
+             "node_exporter's textfile collector"
+    )
+    parser.add_argument(
+        '--profiles',
+        nargs='+',
+        default=[],
+        metavar='PROFILE',
+        help='Collect each of these AWS profiles as its own account, in its own '
+             'process, and merge them into one graph'
+    )
+    parser.add_argument(
+        '--roles',
+        nargs='+',
+        default=[],
+        metavar='ROLE_ARN',
+        help='Collect each account by assuming these roles with the default '
+             'credentials, as for --profiles'
+    )
+    parser.add_argument(
+        '--account-workers',
+        type=int,
+        help='Number of accounts to collect at once (default: all of them)'
+    )
+    args = parser.parse_args(argv)
+    if args.offline and (args.flush is not None or args.migrate_cache):
+        parser.error('--offline only reads the cache, it cannot be used with --flush or --migrate-cache')
+    return args
+
+
+def configure(args):
+    ''' Apply the command line settings, open the cache and flush it if asked '''
+    global fan_out_workers, offline, decode_workers, external_services
+    fan_out_workers = args.fan_out_workers
+    offline = args.offline
+    decode_workers = args.decode_workers
+    external_services = load_services(args.external_services)
+
+    configure_clients(
+        max_pool_connections=args.max_pool_connections,
+        max_attempts=args.max_attempts,
+        retry_mode=args.retry_mode,
+    )
+
+    global cache_store
+    cache_store = open_cache(args.cache_backend)
+
+    if args.migrate_cache:
+        target = cache_store if args.cache_backend == 'sqlite' else open_cache('sqlite')
+        migrate_cache(FileCache(cache_dir), target)
+
+    for api, seconds in args.ttl:
+        cache_ttls[api] = seconds
+
+    if args.flush is not None:
+        for selector in args.flush or ['']:
+            flush_cache(*(selector.split(':') + [None, None])[:3])
+
+
+def collect(args, data_dir):
+    '''
+    Collect the current account, writing its CSVs (and incremental state)
+    to data_dir. Returns the nodes and edges.
+    '''
+    nodes = {}
+    edges = {}
+
+    state_filename = os.path.join(data_dir, 'state.json.gz')
+    delta_filename = os.path.join(data_dir, 'delta.json')
+
+    # Make dirs for storage
+    make_dirs(data_dir)
+
+    with run_metrics.stage('build units'):
+        units = build_units(global_region, region_list)
+
+    if args.incremental:
+        state = read_state(state_filename)
+        previous = {entry['name']: entry for entry in state['units']}
+        if state.get('external_services') != get_external_services().digest:
+            # units classified DNS names with other external services last time
+            previous = {}
+        current = {}
+        with run_metrics.stage('collect'):
+            collect_units(units, nodes, edges, workers=args.workers,
+                          run=partial(run_unit_incremental, previous, current))
+
+        with run_metrics.stage('write state'):
+            write_state(state_filename, units, current)
+            write_delta(delta_filename, graph_delta(*state_graph(state), nodes, edges), current)
+    else:
+        with run_metrics.stage('collect'):
+            collect_units(units, nodes, edges, workers=args.workers)
+
+    with run_metrics.stage('write csv'):
+        write_csv(nodes.values(), os.path.join(data_dir, 'nodes.csv'), node_fields)
+        write_csv(edges.values(), os.path.join(data_dir, 'edges.csv'), edge_fields)
+
+    run_metrics.set('units', len(units))
+    run_metrics.set('collected_nodes', len(nodes))
+    run_metrics.set('collected_edges', len(edges))
+
+    return nodes, edges
+
+
+def publish(args, nodes, edges, data_dir):
+    ''' Build the graph and write everything the server and viewer load to data_dir '''
+    layout_filename = os.path.join(data_dir, 'layout.json.gz')
+
+    with run_metrics.stage('build graph'):
+        graph = build_graph(nodes, edges)
+    if not args.no_layout:
+        with run_metrics.stage('layout'):
+            save_layout(layout_filename, layout_graph(graph, read_layout(layout_filename)))
+    with run_metrics.stage('save graph'):
+        graph.save(os.path.join(data_dir, 'graph.json.gz'))
+        graph.save_elements(os.path.join(data_dir, 'elements.json.gz'))
+    with run_metrics.stage('shards'):
+        write_shards(graph, os.path.join(data_dir, 'shards'))
+
+    run_metrics.set('graph_nodes', graph.node_count)
+    run_metrics.set('graph_edges', graph.edge_count)
+    run_metrics.set('dangling_edges', len(graph.dangling))
+
+
+def metrics_summary():
+    ''' The run metrics with the external service match counts '''
+    summary = run_metrics.summary()
+    summary['external_services'] = get_external_services().stats()
+    summary['values']['external_service_lookups'] = summary['external_services']['lookups']
+    summary['values']['external_service_matches'] = summary['external_services']['matches']
+    return summary
+
+
+def write_metrics(args, data_dir, accounts=None):
+    '''
+    Write the run metrics to data_dir/metrics.json, and as Prometheus text
+    if asked. accounts has the metrics of each account collected by its own
+    process, keyed on label.
+    '''
+    summary = metrics_summary()
+    if accounts is not None:
+        summary['accounts'] = accounts
+    write_json_file(os.path.join(data_dir, 'metrics.json'), summary)
+
+    if args.metrics_prometheus:
+        summaries = [({}, summary)] + [
+            ({'account': label}, account) for label, account in sorted((accounts or {}).items())
+        ]
+        tmp_filename = args.metrics_prometheus + '.tmp'
+        with open(tmp_filename, 'w') as file:
+            file.write(prometheus_text(summaries))
+        os.replace(tmp_filename, args.metrics_prometheus)
+
+    for name, account in sorted(accounts.items()) if accounts else [(None, summary)]:
+        queries = account['totals']['queries']
+        logger.info('%squeries: %d (%d from memory, %d from cache, %d fetched, %d errors), '
+                    '%d requests, %d retries, %d throttled',
+                    'account {} '.format(name) if name else '',
+                    queries['queries'], queries['memo_hits'], queries['cache_hits'], queries['fetches'],
+                    queries['errors'], queries['requests'], queries['retries'], queries['throttles'])
+
+
+def account_label(profile=None, role_arn=None):
+    ''' Name an account by its profile, or by the account id in its role ARN '''
+    if role_arn:
+        return role_arn.split(':')[4]
+    return profile
+
+
+def collect_account(args, profile=None, role_arn=None, max_bytes=None):
+    '''
+    Collect one account with its own cache under cache/<account> and its own
+    CSVs under data/accounts/<account>. Runs in a process of its own, see
+    collect_accounts. The account's cache is pruned to max_bytes, its share
+    of --cache-max-mb. Returns (label, account id, nodes, edges, metrics).
+    '''
+    global cache_dir, account_id, run_metrics
+    label = account_label(profile, role_arn)
+
+    # a process can be reused for another account, start from scratch
+    cache_dir = os.path.join(accounts_cache_dir, label)
+    account_id = None
+    run_metrics = Metrics()
+    with memo_lock:
+        memo.clear()
+
+    configure(args)
+    if not offline:
+        configure_session(profile=profile, role_arn=role_arn)
+    try:
+        if args.flush_only:
+            return label, None, {}, {}, metrics_summary()
+
+        nodes, edges = collect(args, os.path.join(accounts_data_dir, label))
+        if not offline:
+            prune_cache(args.cache_max_mb * 1024 * 1024 if max_bytes is None else max_bytes)
+
+        try:
+            account = get_aws_account_id()
+        except CacheMissError:
+            # offline with a cache from before the account id was cached,
+            # collecting did not need it
+            account = role_arn.split(':')[4] if role_arn else None
+        logger.info('account %s (%s): %d nodes, %d edges',
+                    label, account or 'unknown account id', len(nodes), len(edges))
+
+        return label, account, nodes, edges, metrics_summary()
+    finally:
+        cache_store.close()
+        close_decode_pool()
+
+
+def cross_account_edges(results):
+    '''
+    Edges from an account to nodes that only other accounts collected, such
+    as a DNS name in one account pointing at a load balancer in another.
+    Returns (label, edge, label of the accounts that have the node) tuples.
+    '''
+    owners = {}
+    for label, _, account_nodes, _, _ in results:
+        for key in account_nodes:
+            owners.setdefault(key, []).append(label)
+
+    found = []
+    for label, _, account_nodes, account_edges, _ in results:
+        for edge in account_edges.values():
+            for key in (edge.from_type + '_' + edge.from_name, edge.to_type + '_' + edge.to_name):
+                if key not in account_nodes and key in owners:
+                    found.append((label, edge, owners[key]))
+                    break
+
+    return found
+
+
+def collect_accounts(args):
+    '''
+    Collect every account from --profiles and --roles in parallel, one
+    process each, and merge them into one graph in data/. Nodes with the
+    same type and name in more than one account, shared DNS names for
+    example, become one node, which joins up edges between accounts.
+    '''
+    accounts = [(profile, None) for profile in args.profiles] + [(None, role) for role in args.roles]
+    labels = [account_label(*account) for account in accounts]
+    if len(set(labels)) != len(labels):
+        logger.error('each account can only be collected once: %s', ', '.join(labels))
+        sys.exit(1)
+
+    # the accounts classify DNS names, but the summary here lists the services too
+    global external_services
+    external_services = load_services(args.external_services)
+
+    results = []
+    failed = []
+    with ProcessPoolExecutor(max_workers=args.account_workers or len(accounts)) as executor:
+        # --cache-max-mb caps all the account caches together
+        max_bytes = args.cache_max_mb * 1024 * 1024 // len(accounts)
+        futures = [executor.submit(collect_account, args, *account, max_bytes) for account in accounts]
+        for label, future in zip(labels, futures):
+            try:
+                results.append(future.result())
+            except CacheMissError as error:
+                logger.error('account %s failed: %s, run without --offline to fetch it', label, error)
+                failed.append(label)
+            except Exception as error:
+                logger.error('account %s failed: %s', label, error)
+                failed.append(label)
+
+    if not results:
+        # keep the last run's data rather than replacing it with nothing
+        logger.error('every account failed, data/ is unchanged')
+    elif not args.flush_only:
+        nodes = {}
+        edges = {}
+        for _, _, account_nodes, account_edges, _ in results:
+            merge_graph(nodes, edges, account_nodes, account_edges)
+
+        cross = cross_account_edges(results)
+        logger.info('%d accounts: %d nodes, %d edges, %d between accounts',
+                    len(results), len(nodes), len(edges), len(cross))
+        for label, edge, owners in cross:
+            logger.debug('cross account edge from %s: %s_%s -> %s_%s (%s)', label,
+                         edge.from_type, edge.from_name, edge.to_type, edge.to_name, ', '.join(owners))
+
+        make_dirs('data')
+        with run_metrics.stage('write csv'):
+            write_csv(nodes.values(), 'data/nodes.csv', node_fields)
+            write_csv(edges.values(), 'data/edges.csv', edge_fields)
+        publish(args, nodes, edges, 'data')
+        write_metrics(args, 'data', {label: metrics for label, _, _, _, metrics in results})
+
+    if failed:
+        logger.error('accounts that failed: %s', ', '.join(failed))
+        sys.exit(1)
+
+
+def main(argv=None):
+    ''' Main function to kick it all off '''
+    global run_metrics
+    args = parse_args(argv)
+    # start the counters and the clock afresh, main() can run more than once
+    run_metrics = Metrics()
+
+    if args.profiles or args.roles:
+        collect_accounts(args)
+        return
+
+    configure(args)
+    if args.flush_only:
+        return
+
+    try:
+        nodes, edges = collect(args, 'data')
+    except CacheMissError as error:
+        logger.error('%s, run without --offline to fetch it', error)
+        sys.exit(1)
+    finally:
+        close_decode_pool()
+    publish(args, nodes, edges, 'data')
+
+    if not offline:
+        prune_cache(args.cache_max_mb * 1024 * 1024)
+    write_metrics(args, 'data')
 
 
 if __name__ == "__main__":
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Spot DNS names that point at external services, such as a CNAME to
+Zendesk or a certificate validation record, by their domain suffix.
+
+The services and their suffixes come from a JSON file mapping each
+service name to a list of suffixes, see external_services.json, and
+external_services.example.json for a longer list. A name matches a
+suffix on whole labels only, so zendesk.com matches help.zendesk.com but
+not notzendesk.com, and the longest matching suffix wins. Suffixes are
+kept in a trie keyed on their labels from the right, so a lookup walks
+at most one dict per label of the name, however many suffixes there
+are, and most names leave the trie after a label or two.
+'''
+
+import hashlib
+import json
+import logging
+import os
+import threading
+
+logger = logging.getLogger('main')
+
+# The services file next to this one, used unless another is given
+default_services_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'external_services.json')
+
+
+def normalise(name):
+    ''' Lower case a DNS name without leading or trailing dots '''
+    return name.strip().lower().strip('.')
+
+
+class ServiceClassifier:
+    ''' Looks up the external service of DNS names, keeping count of the matches '''
+
+    def __init__(self, services):
+        '''
+        services maps each service name to a list of its suffixes.
+        A suffix listed for two services stays with the first.
+        '''
+        self.suffixes = {}
+        for service, suffixes in services.items():
+            for suffix in suffixes:
+                suffix = normalise(suffix)
+                if not suffix:
+                    continue
+                if suffix in self.suffixes and self.suffixes[suffix] != service:
+                    logger.warning('external service suffix %s is listed for %s and %s, using %s',
+                                   suffix, self.suffixes[suffix], service, self.suffixes[suffix])
+                    continue
+                self.suffixes[suffix] = service
+
+        # each node maps a label to the next node, and None to the
+        # (service, suffix) ending there, if any
+        self.trie = {}
+        for suffix, service in self.suffixes.items():
+            node = self.trie
+            for label in reversed(suffix.split('.')):
+                node = node.setdefault(label, {})
+            node[None] = (service, suffix)
+
+        self.digest = hashlib.sha1(
+            json.dumps(sorted(self.suffixes.items()), separators=(',', ':')).encode()
+        ).hexdigest()
+
+        self.lock = threading.Lock()
+        self.lookups = 0
+        self.matches = {}
+
+    def match(self, name):
+        ''' The (service, suffix) a DNS name matches, or None '''
+        found = None
+        node = self.trie
+        for label in reversed(normalise(name).split('.')):
+            node = node.get(label)
+            if node is None:
+                break
+            # keep going, a longer suffix wins
+            found = node.get(None, found)
+        return found
+
+    def classify(self, name):
+        ''' The external service of a DNS name, or None '''
+        found = self.match(name)
+        with self.lock:
+            self.lookups += 1
+            if found is not None:
+                self.matches[found] = self.matches.get(found, 0) + 1
+        return None if found is None else found[0]
+
+    def stats(self):
+        ''' Lookups, matches and the matches of each service and suffix '''
+        with self.lock:
+            services = {}
+            for (service, suffix), count in self.matches.items():
+                entry = services.setdefault(service, {'matches': 0, 'suffixes': {}})
+                entry['matches'] += count
+                entry['suffixes'][suffix] = count
+            return {
+                'suffixes': len(self.suffixes),
+                'lookups': self.lookups,
+                'matches': sum(self.matches.values()),
+                'services': services,
+            }
+
+
+def load_services(filename=default_services_file):
+    ''' Load the classifier from a services file '''
+    with open(filename, 'r') as file:
+        services = json.load(file)
+
+    if not isinstance(services, dict) or not all(
+        isinstance(suffixes, list) and all(isinstance(suffix, str) for suffix in suffixes)
+        for suffixes in services.values()
+    ):
+        raise ValueError('{} should map each service name to a list of suffixes'.format(filename))
+
+    classifier = ServiceClassifier(services)
+    logger.debug('read file: %s, %d external service suffixes', filename, len(classifier.suffixes))
+    return classifier
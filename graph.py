@@ -0,0 +1,514 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Integer indexed dependency graph built from the collected nodes and edges.
+
+Every node gets a dense integer id and every edge endpoint is resolved to
+one once. Forward and reverse adjacency are kept as compressed sparse row
+(CSR) arrays so traversals and analysis run in O(V+E).
+'''
+
+import gzip
+import json
+import logging
+import os
+from array import array
+
+logger = logging.getLogger('main')
+
+# Bump when the saved format changes
+graph_version = 1
+
+# Transitive counts stop here, the viewer sizes nodes on them up to 100
+REACH_LIMIT = 1000
+
+# gzip level for saved files, 9 is much slower for a few percent smaller
+GZIP_LEVEL = 6
+
+
+def node_id(node_type, name):
+    ''' The id of a node, the same as the frontend uses '''
+    return node_type + '_' + name
+
+
+def save_gzip_json(filename, data, default=None):
+    '''
+    Save data as gzipped JSON, replacing any existing file in one go.
+    The gzip header carries no name or time, so the same data always gives
+    the same bytes and the same ETag. default is passed on to json.dumps.
+    '''
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'wb') as raw:
+        with gzip.GzipFile(filename='', fileobj=raw, mode='wb', compresslevel=GZIP_LEVEL, mtime=0) as file:
+            file.write(json.dumps(data, separators=(',', ':'), default=default).encode())
+    os.replace(tmp_filename, filename)
+    logger.debug("wrote file: %s", filename)
+
+
+def build_csr(count, sources, targets):
+    '''
+    Build CSR adjacency for count nodes from parallel source and target
+    index arrays. Returns (offsets, neighbours, edge_index) where the
+    neighbours of node v are neighbours[offsets[v]:offsets[v + 1]] and
+    edge_index maps each of those back to its position in sources.
+    '''
+    offsets = array('l', [0]) * (count + 1)
+    for source in sources:
+        offsets[source + 1] += 1
+    for index in range(count):
+        offsets[index + 1] += offsets[index]
+
+    fill = array('l', offsets[:count])
+    neighbours = array('l', [0]) * len(sources)
+    edge_index = array('l', [0]) * len(sources)
+    for index, (source, target) in enumerate(zip(sources, targets)):
+        position = fill[source]
+        neighbours[position] = target
+        edge_index[position] = index
+        fill[source] += 1
+
+    return offsets, neighbours, edge_index
+
+
+def strongly_connected_components(graph):
+    '''
+    Tarjan's algorithm, without recursion so deep chains don't hit the
+    recursion limit. Returns (component of each node, members of each
+    component) with components in reverse topological order, so everything
+    a component depends on comes before it.
+    '''
+    count = graph.node_count
+    order = [-1] * count
+    low = [0] * count
+    on_stack = [False] * count
+    stack = []
+    component = [-1] * count
+    components = []
+    counter = 0
+
+    for root in range(count):
+        if order[root] != -1:
+            continue
+
+        order[root] = low[root] = counter
+        counter += 1
+        stack.append(root)
+        on_stack[root] = True
+        work = [(root, graph.out_offsets[root])]
+
+        while work:
+            node, position = work[-1]
+            if position < graph.out_offsets[node + 1]:
+                work[-1] = (node, position + 1)
+                target = graph.out_targets[position]
+                if order[target] == -1:
+                    order[target] = low[target] = counter
+                    counter += 1
+                    stack.append(target)
+                    on_stack[target] = True
+                    work.append((target, graph.out_offsets[target]))
+                elif on_stack[target]:
+                    low[node] = min(low[node], order[target])
+                continue
+
+            work.pop()
+            if work:
+                parent = work[-1][0]
+                low[parent] = min(low[parent], low[node])
+
+            if low[node] == order[node]:
+                members = []
+                while True:
+                    member = stack.pop()
+                    on_stack[member] = False
+                    component[member] = len(components)
+                    members.append(member)
+                    if member == node:
+                        break
+                components.append(members)
+
+    return component, components
+
+
+def reach_counts(order, offsets, links, sizes, degrees, cyclic, limit):
+    '''
+    Count, for each component of a condensation, the nodes reachable through
+    the CSR links (offsets, links) and the edges followed to get there, the same as Cytoscape's
+    successors() (or predecessors() with reversed links) counts them.
+    Counts stop at limit.
+
+    Components are visited in order, which must put every component after
+    the ones it links to. Each keeps the set of components it reaches until
+    the last component linking to it has used it. A component that reaches
+    limit or more nodes and edges is saturated, and so is everything that
+    links to it, so no set ever holds more than limit components.
+    '''
+    uses = [0] * len(sizes)
+    for target in links:
+        uses[target] += 1
+
+    # nodes and edges each component adds when reached
+    weights = [size + degree for size, degree in zip(sizes, degrees)]
+
+    # components reached by each component, None once saturated
+    reach = {}
+    counts = [0] * len(sizes)
+    for index in order:
+        # a component in a cycle, or with a self loop, reaches itself
+        reached = {index} if cyclic[index] else set()
+        for target in links[offsets[index]:offsets[index + 1]]:
+            if reached is not None:
+                target_reach = reach[target]
+                if target_reach is None or len(reached) + len(target_reach) >= limit:
+                    reached = None
+                else:
+                    reached |= target_reach
+                    reached.add(target)
+            uses[target] -= 1
+            if not uses[target]:
+                del reach[target]
+
+        count = limit
+        if reached is not None:
+            count = sum(map(weights.__getitem__, reached))
+            if index not in reached:
+                count += degrees[index]
+            if count >= limit:
+                count = limit
+                reached = None
+
+        counts[index] = count
+        if uses[index]:
+            reach[index] = reached
+
+    return counts
+
+
+class Graph:
+    '''
+    Node attributes are kept as columns indexed by node id, edge attributes
+    as columns indexed by edge number. Edges whose endpoints are not nodes
+    are kept aside in dangling rather than in the adjacency.
+    '''
+
+    def __init__(self):
+        self.ids = []
+        self.index = {}
+        self.types = []
+        self.names = []
+        self.descriptions = []
+        self.regions = []
+        self.counters = []
+
+        self.sources = array('l')
+        self.targets = array('l')
+        self.edge_types = []
+        self.edge_weights = []
+        self.edge_counters = []
+
+        self.dangling = []
+
+        # (x, y) per node once laid out, see layout.py
+        self.positions = None
+
+        # Transitive counts per node once worked out, see count_reachable
+        self.successor_counts = None
+        self.predecessor_counts = None
+
+        self.out_offsets = self.out_targets = self.out_edges = array('l')
+        self.in_offsets = self.in_sources = self.in_edges = array('l')
+
+    @classmethod
+    def build(cls, nodes, edges):
+        '''
+        Build the graph from collected Node and Edge records, resolving
+        every edge endpoint to a node id once
+        '''
+        graph = cls()
+        for node in nodes:
+            graph.add_node(node.type, node.name, node.description, node.region, node.counter)
+
+        for edge in edges:
+            source = graph.index.get(node_id(edge.from_type, edge.from_name))
+            target = graph.index.get(node_id(edge.to_type, edge.to_name))
+            if source is None or target is None:
+                graph.dangling.append({
+                    'source': node_id(edge.from_type, edge.from_name),
+                    'target': node_id(edge.to_type, edge.to_name),
+                    'type': edge.edge,
+                    'missing': 'both' if source is None and target is None
+                               else 'source' if source is None else 'target',
+                })
+                continue
+
+            graph.sources.append(source)
+            graph.targets.append(target)
+            graph.edge_types.append(edge.edge)
+            graph.edge_weights.append(edge.weight)
+            graph.edge_counters.append(edge.counter)
+
+        graph.index_edges()
+        return graph
+
+    def add_node(self, node_type, name, description=None, region=None, counter=None):
+        ''' Add a node, returning its integer id '''
+        key = node_id(node_type, name)
+        if key in self.index:
+            return self.index[key]
+
+        self.index[key] = len(self.ids)
+        self.ids.append(key)
+        self.types.append(node_type)
+        self.names.append(name)
+        self.descriptions.append(description)
+        self.regions.append(region)
+        self.counters.append(counter)
+        return self.index[key]
+
+    def index_edges(self):
+        ''' Build the forward and reverse CSR adjacency from the edge columns '''
+        self.out_offsets, self.out_targets, self.out_edges = build_csr(
+            len(self.ids), self.sources, self.targets
+        )
+        self.in_offsets, self.in_sources, self.in_edges = build_csr(
+            len(self.ids), self.targets, self.sources
+        )
+
+    @property
+    def node_count(self):
+        ''' Number of nodes '''
+        return len(self.ids)
+
+    @property
+    def edge_count(self):
+        ''' Number of resolved edges '''
+        return len(self.sources)
+
+    def successors(self, node):
+        ''' Ids of the nodes a node depends on directly '''
+        return self.out_targets[self.out_offsets[node]:self.out_offsets[node + 1]]
+
+    def predecessors(self, node):
+        ''' Ids of the nodes that depend directly on a node '''
+        return self.in_sources[self.in_offsets[node]:self.in_offsets[node + 1]]
+
+    def out_degree(self, node):
+        ''' Number of edges out of a node '''
+        return self.out_offsets[node + 1] - self.out_offsets[node]
+
+    def in_degree(self, node):
+        ''' Number of edges into a node '''
+        return self.in_offsets[node + 1] - self.in_offsets[node]
+
+    def count_reachable(self):
+        '''
+        Work out how many nodes and edges each node reaches downstream and
+        upstream, as the frontend's successorcount and predecessorcount,
+        up to REACH_LIMIT. Strongly connected components (CNAME loops and
+        the like) are collapsed first, so every node in a cycle gets the
+        same counts and the whole thing is a single pass over the
+        condensation each way.
+        '''
+        component, components = strongly_connected_components(self)
+        count = len(components)
+
+        # the links between components, once each, as CSR both ways
+        sources = array('l')
+        targets = array('l')
+        cyclic = [len(members) > 1 for members in components]
+        sizes = [len(members) for members in components]
+        out_degrees = [0] * count
+        in_degrees = [0] * count
+        for index, members in enumerate(components):
+            linked = set()
+            for node in members:
+                linked.update(component[target] for target in self.successors(node))
+                out_degrees[index] += self.out_degree(node)
+                in_degrees[index] += self.in_degree(node)
+            if index in linked:
+                cyclic[index] = True
+                linked.discard(index)
+            sources.extend([index] * len(linked))
+            targets.extend(linked)
+
+        forward_offsets, forward, _ = build_csr(count, sources, targets)
+        backward_offsets, backward, _ = build_csr(count, targets, sources)
+        del sources, targets
+
+        # components come out of Tarjan's with dependencies first
+        successors = reach_counts(range(count), forward_offsets, forward,
+                                  sizes, out_degrees, cyclic, REACH_LIMIT)
+        predecessors = reach_counts(range(count - 1, -1, -1), backward_offsets, backward,
+                                    sizes, in_degrees, cyclic, REACH_LIMIT)
+
+        self.successor_counts = [successors[component[node]] for node in range(self.node_count)]
+        self.predecessor_counts = [predecessors[component[node]] for node in range(self.node_count)]
+
+    def node_data(self, node):
+        ''' The attributes of a node as a dict '''
+        data = {
+            'id': self.ids[node],
+            'type': self.types[node],
+            'name': self.names[node],
+            'description': self.descriptions[node],
+            'region': self.regions[node],
+            'counter': self.counters[node],
+        }
+        if self.successor_counts is not None:
+            data['successorcount'] = self.successor_counts[node]
+            data['predecessorcount'] = self.predecessor_counts[node]
+            data['importance'] = self.predecessor_counts[node]
+            data['root'] = int(self.in_degree(node) == 0)
+            data['leaf'] = int(self.out_degree(node) == 0)
+        return data
+
+    def edge_data(self, edge):
+        ''' The attributes of an edge as a dict '''
+        return {
+            'source': self.ids[self.sources[edge]],
+            'target': self.ids[self.targets[edge]],
+            'type': self.edge_types[edge],
+            'weight': self.edge_weights[edge],
+            'counter': self.edge_counters[edge],
+        }
+
+    def node_element(self, node):
+        ''' A node as a Cytoscape element, with its position once laid out '''
+        element = {'data': self.node_data(node)}
+        if self.positions is not None:
+            x, y = self.positions[node]
+            element['position'] = {'x': x, 'y': y}
+        return element
+
+    def to_elements(self):
+        '''
+        The graph as a Cytoscape elements document, with node ids and edge
+        endpoints already resolved. Dangling edges are left out as
+        Cytoscape cannot add them. Nodes carry their position once the
+        graph has been laid out.
+        '''
+        return {
+            'nodes': [self.node_element(node) for node in range(self.node_count)],
+            'edges': [{'data': self.edge_data(edge)} for edge in range(self.edge_count)],
+        }
+
+    def neighbourhood(self, seeds, hops, direction='both', limit=None):
+        '''
+        The nodes within hops of the seed nodes, following what they depend
+        on ('down'), what depends on them ('up') or both. Stops once there
+        are limit nodes. Returns (nodes nearest first, whether it stopped early).
+        '''
+        found = dict.fromkeys(seeds)
+        frontier = list(found)
+        for _ in range(hops):
+            next_frontier = []
+            for node in frontier:
+                neighbours = []
+                if direction in ('down', 'both'):
+                    neighbours.extend(self.successors(node))
+                if direction in ('up', 'both'):
+                    neighbours.extend(self.predecessors(node))
+                for neighbour in neighbours:
+                    if neighbour in found:
+                        continue
+                    if limit is not None and len(found) >= limit:
+                        return list(found), True
+                    found[neighbour] = None
+                    next_frontier.append(neighbour)
+            frontier = next_frontier
+
+        return list(found), False
+
+    def subgraph_elements(self, nodes):
+        '''
+        Cytoscape elements for some of the nodes and the edges between them.
+        Edges get ids so a client adding several subgraphs can skip ones it
+        already has, and nodes get their degree so it can tell which have
+        edges it hasn't loaded yet.
+        '''
+        included = set(nodes)
+        elements = {'nodes': [], 'edges': []}
+        for node in nodes:
+            element = self.node_element(node)
+            element['data']['degree'] = self.out_degree(node) + self.in_degree(node)
+            elements['nodes'].append(element)
+            for position in range(self.out_offsets[node], self.out_offsets[node + 1]):
+                if self.out_targets[position] in included:
+                    edge = self.out_edges[position]
+                    data = self.edge_data(edge)
+                    data['id'] = 'edge_{}'.format(edge)
+                    elements['edges'].append({'data': data})
+        return elements
+
+    def save_elements(self, filename):
+        ''' Save the Cytoscape elements as gzipped JSON for the browser to load in one go '''
+        save_gzip_json(filename, self.to_elements())
+
+    def to_dict(self):
+        ''' The graph as plain lists, ready to save as JSON '''
+        return {
+            'version': graph_version,
+            'nodes': {
+                'ids': self.ids,
+                'types': self.types,
+                'names': self.names,
+                'descriptions': self.descriptions,
+                'regions': self.regions,
+                'counters': self.counters,
+                'positions': self.positions,
+                'successor_counts': self.successor_counts,
+                'predecessor_counts': self.predecessor_counts,
+            },
+            'edges': {
+                'sources': self.sources.tolist(),
+                'targets': self.targets.tolist(),
+                'types': self.edge_types,
+                'weights': self.edge_weights,
+                'counters': self.edge_counters,
+            },
+            'dangling': self.dangling,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        ''' Rebuild a graph saved with to_dict '''
+        if data.get('version') != graph_version:
+            raise ValueError('unsupported graph version: {}'.format(data.get('version')))
+
+        graph = cls()
+        nodes = data['nodes']
+        graph.ids = nodes['ids']
+        graph.index = {key: index for index, key in enumerate(graph.ids)}
+        graph.types = nodes['types']
+        graph.names = nodes['names']
+        graph.descriptions = nodes['descriptions']
+        graph.regions = nodes['regions']
+        graph.counters = nodes['counters']
+        if nodes.get('positions') is not None:
+            graph.positions = [tuple(position) for position in nodes['positions']]
+        graph.successor_counts = nodes.get('successor_counts')
+        graph.predecessor_counts = nodes.get('predecessor_counts')
+
+        edges = data['edges']
+        graph.sources = array('l', edges['sources'])
+        graph.targets = array('l', edges['targets'])
+        graph.edge_types = edges['types']
+        graph.edge_weights = edges['weights']
+        graph.edge_counters = edges['counters']
+
+        graph.dangling = data.get('dangling', [])
+        graph.index_edges()
+        return graph
+
+    def save(self, filename):
+        ''' Save the graph as gzipped JSON, replacing any existing file in one go '''
+        save_gzip_json(filename, self.to_dict())
+
+    @classmethod
+    def load(cls, filename):
+        ''' Load a graph saved with save '''
+        with gzip.open(filename, 'rt') as file:
+            graph = cls.from_dict(json.load(file))
+        logger.debug("read file: %s", filename)
+        return graph
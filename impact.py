@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Blast radius queries: which nodes depend, directly or through any chain of
+dependencies, on a set of failed nodes.
+
+The index collapses strongly connected components and keeps, for each
+component, the components that depend on it directly. Upstream closures
+are walked over that and cached, so repeated queries for the same nodes
+are a set union. Sessions keep a count per affected component of how many
+failed nodes reach it, so failing or restoring one node only walks that
+node's own closure.
+'''
+
+import threading
+from collections import OrderedDict
+
+from graph import strongly_connected_components
+
+# Upstream closures to keep cached per index
+CLOSURE_CACHE_SIZE = 4096
+
+
+class ImpactIndex:
+    ''' Reverse reachability over the condensation of a graph '''
+
+    def __init__(self, graph, cache_size=CLOSURE_CACHE_SIZE):
+        self.graph = graph
+        self.component, self.members = strongly_connected_components(graph)
+
+        dependants = [set() for _ in self.members]
+        self.cyclic = [len(members) > 1 for members in self.members]
+        for source, target in zip(graph.sources, graph.targets):
+            if self.component[source] == self.component[target]:
+                self.cyclic[self.component[source]] = True
+            else:
+                dependants[self.component[target]].add(self.component[source])
+        self.dependants = [tuple(sorted(found)) for found in dependants]
+
+        self.closures = OrderedDict()
+        self.closures_lock = threading.Lock()
+        self.cache_size = cache_size
+
+    def lookup(self, ids):
+        ''' Resolve node ids to node indexes. Returns (indexes, ids that are not in the graph) '''
+        found = []
+        unknown = []
+        for key in ids:
+            if key in self.graph.index:
+                found.append(self.graph.index[key])
+            else:
+                unknown.append(key)
+        return found, unknown
+
+    def upstream(self, component):
+        '''
+        The components that depend on a component through one or more edges,
+        which includes the component itself if it is a cycle
+        '''
+        with self.closures_lock:
+            if component in self.closures:
+                self.closures.move_to_end(component)
+                return self.closures[component]
+
+        seen = set()
+        pending = list(self.dependants[component])
+        while pending:
+            current = pending.pop()
+            if current not in seen:
+                seen.add(current)
+                pending.extend(self.dependants[current])
+        if self.cyclic[component]:
+            seen.add(component)
+        closure = frozenset(seen)
+
+        with self.closures_lock:
+            self.closures[component] = closure
+            if len(self.closures) > self.cache_size:
+                self.closures.popitem(last=False)
+        return closure
+
+    def affected_components(self, nodes):
+        ''' The components affected by failed node indexes '''
+        affected = set()
+        for component in {self.component[node] for node in nodes}:
+            affected |= self.upstream(component)
+        return affected
+
+    def node_ids(self, components):
+        ''' The sorted ids of the nodes in components '''
+        return sorted(self.graph.ids[node] for component in components for node in self.members[component])
+
+    def impact(self, ids):
+        ''' The blast radius of failed node ids, as a dict ready to return as JSON '''
+        failed, unknown = self.lookup(ids)
+        affected = self.node_ids(self.affected_components(failed))
+        return {
+            'failed': sorted(self.graph.ids[node] for node in set(failed)),
+            'unknown': unknown,
+            'affected': affected,
+            'count': len(affected),
+        }
+
+
+class ImpactSession:
+    '''
+    A set of failed nodes that changes over time, such as during an incident.
+    Hold lock while calling update or state from more than one thread.
+    '''
+
+    def __init__(self, index):
+        self.index = index
+        self.failed = set()
+        # how many failed nodes reach each affected component
+        self.counts = {}
+        self.lock = threading.Lock()
+
+    def update(self, add=(), remove=()):
+        '''
+        Fail the node ids in add and restore the ones in remove. Returns the
+        node ids that became affected and stopped being affected, plus
+        any ids not in the graph.
+        '''
+        added, unknown = self.index.lookup(add)
+        removed, unknown_removed = self.index.lookup(remove)
+
+        became = set()
+        stopped = set()
+        for node in added:
+            if node in self.failed:
+                continue
+            self.failed.add(node)
+            for component in self.index.upstream(self.index.component[node]):
+                self.counts[component] = self.counts.get(component, 0) + 1
+                if self.counts[component] == 1:
+                    became.add(component)
+
+        for node in removed:
+            if node not in self.failed:
+                continue
+            self.failed.remove(node)
+            for component in self.index.upstream(self.index.component[node]):
+                self.counts[component] -= 1
+                if not self.counts[component]:
+                    del self.counts[component]
+                    stopped.add(component)
+
+        return {
+            # a component can become affected and stop again within one update
+            'added': self.index.node_ids(became - stopped),
+            'removed': self.index.node_ids(stopped - became),
+            'unknown': unknown + unknown_removed,
+        }
+
+    def affected_count(self):
+        ''' Number of affected nodes '''
+        return sum(len(self.index.members[component]) for component in self.counts)
+
+    def state(self):
+        ''' The failed and affected node ids, as a dict ready to return as JSON '''
+        affected = self.index.node_ids(self.counts)
+        return {
+            'failed': sorted(self.index.graph.ids[node] for node in self.failed),
+            'affected': affected,
+            'count': len(affected),
+        }
@@ -0,0 +1,275 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Layered layout of the dependency graph, computed at collection time so the
+browser can use Cytoscape's preset layout rather than running cose on load.
+
+Each weakly connected component is laid out top down from the nodes nothing
+depends on, one layer per hop. Nodes are ordered by id and then by the
+average position of the nodes above them, so the same graph always gives
+the same picture. Components that have not changed since the previous
+layout keep their previous positions, and changed ones are put back where
+they were when there is room.
+'''
+
+import gzip
+import json
+import logging
+import math
+from hashlib import sha1
+
+from graph import save_gzip_json
+
+logger = logging.getLogger('main')
+
+# Bump when the saved format changes
+layout_version = 1
+
+NODE_SPACING = 80
+LAYER_SPACING = 160
+# Nodes in a layer before it wraps onto another row
+MAX_ROW = 40
+# Space left around each component
+COMPONENT_GAP = 200
+# Size of the grid squares used to find overlapping components
+GRID_CELL = 2000
+
+
+def components(graph):
+    ''' Split the graph into weakly connected components, each a sorted list of node ids '''
+    seen = [False] * graph.node_count
+    found = []
+    for start in range(graph.node_count):
+        if seen[start]:
+            continue
+        seen[start] = True
+        component = [start]
+        stack = [start]
+        while stack:
+            node = stack.pop()
+            for neighbour in list(graph.successors(node)) + list(graph.predecessors(node)):
+                if not seen[neighbour]:
+                    seen[neighbour] = True
+                    component.append(neighbour)
+                    stack.append(neighbour)
+        found.append(sorted(component, key=graph.ids.__getitem__))
+
+    return found
+
+
+def component_key(graph, component):
+    ''' Hash a component's node ids and edges, which changes if either does '''
+    digest = sha1()
+    for node in component:
+        digest.update(graph.ids[node].encode() + b'\n')
+        for target in sorted(graph.ids[target] for target in graph.successors(node)):
+            digest.update(b'>' + target.encode() + b'\n')
+    return digest.hexdigest()
+
+
+def layers(graph, component):
+    '''
+    Group a component's nodes into layers by their distance from the nodes
+    nothing depends on. Cycles with nothing above them start a new top layer.
+    '''
+    depth = {}
+    pending = [node for node in component if graph.in_degree(node) == 0]
+    remaining = iter(component)
+
+    while len(depth) < len(component):
+        if not pending:
+            # everything left is only reachable through a cycle
+            pending = [next(node for node in remaining if node not in depth)]
+
+        for node in pending:
+            depth.setdefault(node, 0)
+        while pending:
+            next_pending = []
+            for node in pending:
+                for target in graph.successors(node):
+                    if target not in depth:
+                        depth[target] = depth[node] + 1
+                        next_pending.append(target)
+            pending = next_pending
+
+    grouped = [[] for _ in range(max(depth.values()) + 1)]
+    for node in component:
+        grouped[depth[node]].append(node)
+    return grouped
+
+
+def place_component(graph, component):
+    '''
+    Lay out a component with its top left at 0, 0.
+    Returns ({node: (x, y)}, width, height).
+    '''
+    # x relative to the centre line, rows are centred under each other
+    placed = {}
+    rows = []
+    for layer in layers(graph, component):
+        # order by the average x of the nodes above, falling back to id order
+        def barycenter(node):
+            above = [placed[source] for source in graph.predecessors(node) if source in placed]
+            return (sum(above) / len(above) if above else math.inf, graph.ids[node])
+
+        ordered = sorted(layer, key=barycenter)
+        for start in range(0, len(ordered), MAX_ROW):
+            row = ordered[start:start + MAX_ROW]
+            for index, node in enumerate(row):
+                placed[node] = (index - (len(row) - 1) / 2) * NODE_SPACING
+            rows.append(row)
+
+    width = (max(len(row) for row in rows) - 1) * NODE_SPACING
+    positions = {}
+    for row_index, row in enumerate(rows):
+        for node in row:
+            positions[node] = (width / 2 + placed[node], row_index * LAYER_SPACING)
+
+    return positions, width, (len(rows) - 1) * LAYER_SPACING
+
+
+class BoxIndex:
+    '''
+    The boxes (x, y, width, height) placed so far, bucketed into a grid of
+    GRID_CELL squares so checking a box for overlaps only looks at the
+    boxes in the cells around it rather than every box.
+    '''
+
+    def __init__(self):
+        self.boxes = []
+        self.cells = {}
+
+    @staticmethod
+    def cell_range(start, length):
+        return range(int(start // GRID_CELL), int((start + length) // GRID_CELL) + 1)
+
+    def add(self, box):
+        x, y, width, height = box
+        index = len(self.boxes)
+        self.boxes.append(box)
+        for cell_x in self.cell_range(x, width):
+            for cell_y in self.cell_range(y, height):
+                self.cells.setdefault((cell_x, cell_y), []).append(index)
+
+    def overlaps(self, box):
+        ''' Whether a box, plus the gap, overlaps any of the boxes '''
+        x, y, width, height = box
+        checked = set()
+        for cell_x in self.cell_range(x - COMPONENT_GAP, width + 2 * COMPONENT_GAP):
+            for cell_y in self.cell_range(y - COMPONENT_GAP, height + 2 * COMPONENT_GAP):
+                for index in self.cells.get((cell_x, cell_y), ()):
+                    if index in checked:
+                        continue
+                    checked.add(index)
+                    other_x, other_y, other_width, other_height = self.boxes[index]
+                    if (x < other_x + other_width + COMPONENT_GAP and other_x < x + width + COMPONENT_GAP and
+                            y < other_y + other_height + COMPONENT_GAP and other_y < y + height + COMPONENT_GAP):
+                        return True
+        return False
+
+
+def layout_graph(graph, previous=None):
+    '''
+    Work out a position for every node, reusing the previous layout (as
+    returned by read_layout) for components that have not changed.
+    Sets graph.positions and returns the layout to save for next time.
+    '''
+    previous_components = {}
+    previous_owner = {}
+    for component in (previous or {}).get('components', []):
+        previous_components[component['key']] = component
+        for key in component['positions']:
+            previous_owner[key] = component['key']
+
+    positions = [None] * graph.node_count
+    boxes = BoxIndex()
+    saved = []
+    to_place = []
+    reused = 0
+
+    for component in components(graph):
+        key = component_key(graph, component)
+        if key in previous_components:
+            # unchanged, keep it exactly where it was
+            old = previous_components[key]
+            for node in component:
+                positions[node] = tuple(old['positions'][graph.ids[node]])
+            boxes.add(tuple(old['box']))
+            saved.append(old)
+            reused += 1
+            continue
+
+        local, width, height = place_component(graph, component)
+
+        # try to put it back where most of its nodes used to be
+        owners = [previous_owner[graph.ids[node]] for node in component if graph.ids[node] in previous_owner]
+        anchor = None
+        if owners:
+            owner = max(sorted(set(owners)), key=owners.count)
+            anchor = previous_components[owner]['box'][:2]
+
+        to_place.append((component, key, local, width, height, anchor))
+
+    # Anchored components first, biggest first, so they get their old spot
+    to_place.sort(key=lambda item: (item[5] is None, -len(item[0]), item[1]))
+    shelf_width = max(
+        MAX_ROW * NODE_SPACING,
+        math.sqrt(sum((width + COMPONENT_GAP) * (height + COMPONENT_GAP)
+                      for _, _, _, width, height, _ in to_place))
+    )
+
+    def place(component, key, local, box):
+        boxes.add(box)
+        component_positions = {}
+        for node in component:
+            positions[node] = (box[0] + local[node][0], box[1] + local[node][1])
+            component_positions[graph.ids[node]] = positions[node]
+        saved.append({'key': key, 'box': box, 'positions': component_positions})
+
+    # Put anchored components back where they were if there is room, before
+    # any shelf packing, so the shelves start below all of them
+    shelved = []
+    for component, key, local, width, height, anchor in to_place:
+        box = None if anchor is None else (anchor[0], anchor[1], width, height)
+        if box is not None and not boxes.overlaps(box):
+            place(component, key, local, box)
+        else:
+            shelved.append((component, key, local, width, height))
+
+    # Shelf pack the rest below everything already placed
+    shelf_x = 0
+    shelf_y = max([y + h + COMPONENT_GAP for _, y, _, h in boxes.boxes] or [0])
+    shelf_height = 0
+    for component, key, local, width, height in shelved:
+        if shelf_x > 0 and shelf_x + width > shelf_width:
+            shelf_x = 0
+            shelf_y += shelf_height + COMPONENT_GAP
+            shelf_height = 0
+        place(component, key, local, (shelf_x, shelf_y, width, height))
+        shelf_x += width + COMPONENT_GAP
+        shelf_height = max(shelf_height, height)
+
+    graph.positions = positions
+    logger.info('layout: %d components unchanged, %d laid out', reused, len(to_place))
+
+    return {'version': layout_version, 'components': saved}
+
+
+def read_layout(filename):
+    ''' Read a layout saved with save_layout, or None if there isn't a usable one '''
+    try:
+        with gzip.open(filename, 'rt') as file:
+            layout = json.load(file)
+            logger.debug("read file: %s", filename)
+    except (IOError, ValueError):
+        return None
+
+    if layout.get('version') != layout_version:
+        return None
+    return layout
+
+
+def save_layout(filename, layout):
+    ''' Save a layout, replacing any existing file in one go '''
+    save_gzip_json(filename, layout)
@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Counters and timers for a collection run.
+
+Queries are counted per AWS api, method and region: how long they took,
+whether they came from the memo, the cache or AWS, the bytes read from
+and written to the cache, pages, requests, retries and throttles.
+Collectors are counted per collector and region with the nodes and edges
+they made, and the stages of the run, collecting, writing the CSVs,
+laying out the graph and so on, are timed too.
+
+The summary is written as JSON, and optionally in the Prometheus text
+format for node_exporter's textfile collector.
+'''
+
+import threading
+import time
+from contextlib import contextmanager
+
+# Bump when the summary format changes
+metrics_version = 1
+
+# Counted for each api, method and region
+query_counters = (
+    'queries',          # query_aws and query_aws_pages calls
+    'seconds',          # wall time spent in them
+    'memo_hits',
+    'cache_hits',
+    'cache_misses',
+    'cache_read_bytes',
+    'cache_written_bytes',
+    'fetches',          # calls to fetch from AWS
+    'fetch_seconds',
+    'pages',            # pages read by query_aws_pages, cached or not
+    'requests',         # AWS requests, one per page
+    'retries',
+    'throttles',
+    'errors',
+)
+
+# Counted for each collector and region
+collector_counters = (
+    'runs',
+    'reused',           # incremental runs that reused the last run's nodes and edges
+    'seconds',
+    'nodes',
+    'edges',
+)
+
+# Prometheus metric name prefix
+PROMETHEUS_PREFIX = 'infra_viz_'
+
+# Error codes AWS uses for throttling, as botocore's retry handler has them
+THROTTLE_CODES = frozenset([
+    'Throttling',
+    'ThrottlingException',
+    'ThrottledException',
+    'RequestThrottledException',
+    'TooManyRequestsException',
+    'ProvisionedThroughputExceededException',
+    'TransactionInProgressException',
+    'RequestLimitExceeded',
+    'BandwidthLimitExceeded',
+    'LimitExceededException',
+    'RequestThrottled',
+    'SlowDown',
+    'PriorRequestNotComplete',
+    'EC2ThrottledException',
+])
+
+
+class Metrics:
+    ''' Metrics of one run, safe to update from any thread '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.queries = {}
+        self.collectors = {}
+        self.stages = {}
+        self.values = {}
+
+    @staticmethod
+    def add(table, key, counters, counts):
+        ''' Add counts to a row of a table, starting it at zero '''
+        row = table.get(key)
+        if row is None:
+            row = table[key] = dict.fromkeys(counters, 0)
+        for name, value in counts.items():
+            row[name] += value
+
+    def add_query(self, api, method, region, **counts):
+        ''' Add to the counters of an api, method and region, see query_counters '''
+        with self.lock:
+            self.add(self.queries, (api, method, str(region)), query_counters, counts)
+
+    def add_collector(self, collector, region, **counts):
+        ''' Add to the counters of a collector and region, see collector_counters '''
+        with self.lock:
+            self.add(self.collectors, (collector, str(region)), collector_counters, counts)
+
+    @contextmanager
+    def stage(self, name):
+        ''' Time a stage of the run '''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.stages[name] = self.stages.get(name, 0) + time.perf_counter() - start
+
+    def set(self, name, value):
+        ''' Record a value about the run, such as the number of nodes '''
+        with self.lock:
+            self.values[name] = value
+
+    def summary(self):
+        ''' The metrics as a dict ready to save as JSON '''
+        with self.lock:
+            queries = [
+                dict(api=api, method=method, region=region, **row)
+                for (api, method, region), row in sorted(self.queries.items())
+            ]
+            collectors = [
+                dict(collector=collector, region=region, **row)
+                for (collector, region), row in sorted(self.collectors.items())
+            ]
+            return {
+                'version': metrics_version,
+                'started': self.started,
+                'seconds': time.time() - self.started,
+                'values': dict(self.values),
+                'stages': dict(self.stages),
+                'totals': {
+                    'queries': totals(queries, query_counters),
+                    'collectors': totals(collectors, collector_counters),
+                },
+                'queries': queries,
+                'collectors': collectors,
+            }
+
+
+def totals(rows, counters):
+    ''' Sum the counters of rows '''
+    return {name: sum(row[name] for row in rows) for name in counters}
+
+
+def label_text(labels):
+    ''' Format labels as {name="value",...}, escaped as Prometheus wants '''
+    if not labels:
+        return ''
+    return '{' + ','.join(
+        '{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in sorted(labels.items())
+    ) + '}'
+
+
+def prometheus_text(summaries):
+    '''
+    Format metric summaries in the Prometheus text format. Takes
+    [(labels, summary)] so the summaries of several accounts can be written
+    side by side, each with its own labels.
+    '''
+    samples = {}
+
+    def sample(name, kind, help_text, labels, value):
+        name = PROMETHEUS_PREFIX + name
+        if name not in samples:
+            samples[name] = ['# HELP {} {}'.format(name, help_text), '# TYPE {} {}'.format(name, kind)]
+        samples[name].append('{}{} {}'.format(name, label_text(labels), repr(float(value))))
+
+    for labels, summary in summaries:
+        sample('run_timestamp_seconds', 'gauge', 'When the run started', labels, summary['started'])
+        sample('run_seconds', 'gauge', 'How long the run took', labels, summary['seconds'])
+        for name, value in sorted(summary['values'].items()):
+            sample(name, 'gauge', 'Value recorded by the run', labels, value)
+        for stage, seconds in sorted(summary['stages'].items()):
+            sample('stage_seconds', 'gauge', 'Time spent in each stage of the run',
+                   dict(labels, stage=stage), seconds)
+
+        for row in summary['queries']:
+            row_labels = dict(labels, api=row['api'], method=row['method'], region=row['region'])
+            for counter in query_counters:
+                sample('aws_' + counter + '_total', 'counter', 'AWS queries: ' + counter.replace('_', ' '),
+                       row_labels, row[counter])
+
+        for row in summary['collectors']:
+            row_labels = dict(labels, collector=row['collector'], region=row['region'])
+            for counter in collector_counters:
+                sample('collector_' + counter + '_total', 'counter', 'Collectors: ' + counter,
+                       row_labels, row[counter])
+
+    return '\n'.join(line for lines in samples.values() for line in lines) + '\n'
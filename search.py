@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Ranked search over node names, descriptions, types and regions.
+
+Names, and the words in them, are kept in a sorted array for prefix
+lookups with bisect. The text of every node also goes in a trigram index,
+so a substring search only has to check the nodes that have every trigram
+of the query rather than every node.
+'''
+
+import heapq
+import re
+from array import array
+from bisect import bisect_left
+
+# How a node matched, best first
+EXACT, PREFIX, WORD_PREFIX, FIELD, SUBSTRING, OTHER_SUBSTRING = range(6)
+
+# Names are split into words on anything that isn't a letter or digit
+word_split = re.compile(r'[^a-z0-9]+')
+
+
+def trigrams(text):
+    ''' The set of three character substrings of some text '''
+    return {text[index:index + 3] for index in range(len(text) - 2)}
+
+
+class SearchIndex:
+    ''' Search index over the nodes of a graph, built once per graph '''
+
+    def __init__(self, graph):
+        self.graph = graph
+        self.names = [str(name).lower() for name in graph.names]
+        self.text = [
+            '\n'.join(str(value).lower() for value in values if value)
+            for values in zip(graph.names, graph.descriptions, graph.types, graph.regions)
+        ]
+
+        prefixes = []
+        for node, name in enumerate(self.names):
+            prefixes.append((name, node, PREFIX))
+            for word in set(word_split.split(name)) - {'', name}:
+                prefixes.append((word, node, WORD_PREFIX))
+        prefixes.sort()
+        self.prefix_keys = [key for key, _, _ in prefixes]
+        self.prefix_nodes = array('l', [node for _, node, _ in prefixes])
+        self.prefix_ranks = bytes(rank for _, _, rank in prefixes)
+
+        self.fields = {}
+        for node, values in enumerate(zip(graph.types, graph.regions)):
+            for value in values:
+                if value:
+                    self.fields.setdefault(value.lower(), []).append(node)
+
+        self.postings = {}
+        for node, text in enumerate(self.text):
+            for gram in trigrams(text):
+                if gram not in self.postings:
+                    self.postings[gram] = array('l')
+                self.postings[gram].append(node)
+
+    def substring_candidates(self, query):
+        ''' Nodes that have every trigram of a query of three or more characters '''
+        postings = sorted((self.postings.get(gram, ()) for gram in trigrams(query)), key=len)
+        candidates = set(postings[0])
+        for posting in postings[1:]:
+            if not candidates:
+                break
+            candidates.intersection_update(posting)
+        return candidates
+
+    def match(self, query, original):
+        '''
+        The best rank of every node matching a lower case query, with the
+        query as typed to match node ids, which are case sensitive
+        '''
+        ranks = {}
+
+        def offer(node, rank):
+            if rank < ranks.get(node, OTHER_SUBSTRING + 1):
+                ranks[node] = rank
+
+        position = bisect_left(self.prefix_keys, query)
+        while position < len(self.prefix_keys) and self.prefix_keys[position].startswith(query):
+            rank = self.prefix_ranks[position]
+            if rank == PREFIX and self.prefix_keys[position] == query:
+                rank = EXACT
+            offer(self.prefix_nodes[position], rank)
+            position += 1
+
+        if original in self.graph.index:
+            offer(self.graph.index[original], EXACT)
+
+        for node in self.fields.get(query, ()):
+            offer(node, FIELD)
+
+        # shorter queries only match prefixes
+        if len(query) >= 3:
+            for node in self.substring_candidates(query):
+                if query in self.names[node]:
+                    offer(node, SUBSTRING)
+                elif query in self.text[node]:
+                    offer(node, OTHER_SUBSTRING)
+
+        return ranks
+
+    def search(self, query, limit=20, node_type=None, region=None):
+        '''
+        Search for nodes, optionally only of a type or in a region.
+        Returns ([(node, rank), ...] best first, total number of matches).
+        Ties go to the nodes more depends on, then to shorter names.
+        '''
+        original = query.strip()
+        query = original.lower()
+        if not query:
+            return [], 0
+
+        ranks = self.match(query, original)
+        if node_type is not None or region is not None:
+            ranks = {
+                node: rank for node, rank in ranks.items()
+                if node_type in (None, self.graph.types[node]) and region in (None, self.graph.regions[node])
+            }
+
+        importance = self.graph.predecessor_counts or [0] * self.graph.node_count
+        best = heapq.nsmallest(
+            limit, ranks,
+            key=lambda node: (ranks[node], -importance[node], len(self.names[node]), self.graph.ids[node])
+        )
+        return [(node, ranks[node]) for node in best], len(ranks)
@@ -1,24 +1,386 @@
-from flask import Flask, render_template, send_from_directory
+import argparse
+import gzip
+import mimetypes
+import os
+import sys
+import threading
+import uuid
+from collections import OrderedDict
+from hashlib import sha1
+from flask import Flask, Response, abort, jsonify, render_template, request, send_file
+from werkzeug.security import safe_join
+
+from graph import Graph
+from impact import ImpactIndex, ImpactSession
+from search import SearchIndex
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import waitress
+except ImportError:
+    waitress = None
 
 app = Flask(__name__)
 
 PORT=5001
 HOST='0.0.0.0'
 
+DATA_DIR = os.path.join(app.root_path, 'data')
+GRAPH_FILE = os.path.join(DATA_DIR, 'graph.json.gz')
+
+# Don't bother compressing files smaller than this
+MIN_COMPRESS_SIZE = 1024
+
+# Content hashes and compressed copies of data files, keyed on the file's
+# path, modified time and size so a rewritten file is picked up
+data_cache = {}
+data_cache_lock = threading.Lock()
+
+# Open impact sessions, oldest first, dropped beyond MAX_SESSIONS
+impact_sessions = OrderedDict()
+impact_sessions_lock = threading.Lock()
+MAX_SESSIONS = 256
+
+# Bounds on neighbourhood requests
+MAX_HOPS = 5
+DEFAULT_NEIGHBOURHOOD_LIMIT = 500
+MAX_NEIGHBOURHOOD_LIMIT = 5000
+# Search matches to start a neighbourhood from
+MAX_SEEDS = 20
+
+DEFAULT_SEARCH_LIMIT = 20
+MAX_SEARCH_LIMIT = 1000
+
+
 @app.route('/')
 def index():
     ''' Render the index page '''
     return render_template('index.html')
 
 
+def file_version(filename):
+    ''' The modified time and size of a file, which change when it is rewritten '''
+    stat = os.stat(filename)
+    return (filename, stat.st_mtime_ns, stat.st_size)
+
+
+def cached_data(key, build):
+    ''' Get a value from the data cache, building it if missing '''
+    with data_cache_lock:
+        if key in data_cache:
+            return data_cache[key]
+
+    value = build()
+    with data_cache_lock:
+        # Drop anything built from older versions of the same file
+        for old_key in [old for old in data_cache if old[0] == key[0] and old[:3] != key[:3]]:
+            del data_cache[old_key]
+        data_cache[key] = value
+    return value
+
+
+def content_hash(filename):
+    ''' A hash of the content of a file, cached until the file changes '''
+    def build():
+        digest = sha1()
+        with open(filename, 'rb') as file:
+            for chunk in iter(lambda: file.read(1024 * 1024), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    return cached_data(file_version(filename) + ('sha1',), build)
+
+
+def compressed(filename, encoding):
+    ''' The file compressed with gzip or br, cached until the file changes '''
+    def build():
+        with open(filename, 'rb') as file:
+            data = file.read()
+        if encoding == 'br':
+            return brotli.compress(data)
+        return gzip.compress(data)
+
+    return cached_data(file_version(filename) + (encoding,), build)
+
+
+def decompressed(filename):
+    ''' A gzipped file decompressed, cached until the file changes '''
+    def build():
+        with gzip.open(filename, 'rb') as file:
+            return file.read()
+
+    return cached_data(file_version(filename) + ('identity',), build)
+
+
+def choose_representation(filename):
+    '''
+    Pick how to serve a data file given what the client accepts.
+    Precompressed .br and .gz siblings are preferred, otherwise the file
+    is compressed on the fly. Returns (source file, encoding, how) where how
+    is 'file' to send as is, 'compress' or 'decompress', or None if there
+    is nothing to serve.
+    '''
+    accepts = request.accept_encodings
+    exists = os.path.isfile(filename)
+
+    if accepts['br'] and os.path.isfile(filename + '.br'):
+        return filename + '.br', 'br', 'file'
+    if accepts['gzip'] and os.path.isfile(filename + '.gz'):
+        return filename + '.gz', 'gzip', 'file'
+
+    if exists:
+        if os.path.getsize(filename) >= MIN_COMPRESS_SIZE:
+            if brotli is not None and accepts['br']:
+                return filename, 'br', 'compress'
+            if accepts['gzip']:
+                return filename, 'gzip', 'compress'
+        return filename, None, 'file'
+
+    # Only a gzipped copy, but the client can't take gzip
+    if os.path.isfile(filename + '.gz'):
+        return filename + '.gz', None, 'decompress'
+
+    return None, None, None
+
+
 @app.route('/data/<path:path>')
 def send_data(path):
-    ''' Method to handle static files to be returned '''
-    return send_from_directory('data', path)
+    '''
+    Method to handle static files to be returned.
+    Responses are compressed where the client accepts it and carry a
+    strong ETag of the content, so an unchanged file is a 304.
+    '''
+    filename = safe_join(DATA_DIR, path)
+    if filename is None:
+        abort(404)
+
+    source, encoding, how = choose_representation(filename)
+    if source is None:
+        abort(404)
+
+    etag = '{}-{}'.format(content_hash(source), encoding or 'identity')
+    mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    elif how == 'compress':
+        response = Response(compressed(source, encoding), mimetype=mimetype)
+    elif how == 'decompress':
+        response = Response(decompressed(source), mimetype=mimetype)
+    else:
+        response = send_file(source, mimetype=mimetype, conditional=False, etag=False)
+
+    response.set_etag(etag)
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.headers['Vary'] = 'Accept-Encoding'
+    # Always check back, the ETag makes that a cheap 304 if nothing changed
+    response.headers['Cache-Control'] = 'no-cache'
+    response.last_modified = os.path.getmtime(source)
+    return response
 
 
 # @app.route('/static') is a magic inbuilt route
 
 
+def current_graph():
+    ''' The collected graph, reloaded when collect.py rewrites it '''
+    if not os.path.isfile(GRAPH_FILE):
+        abort(404)
+    return cached_data(file_version(GRAPH_FILE) + ('graph',), lambda: Graph.load(GRAPH_FILE))
+
+
+def impact_index():
+    ''' The impact index of the collected graph, rebuilt when collect.py rewrites it '''
+    graph = current_graph()
+    return cached_data(file_version(GRAPH_FILE) + ('impact',), lambda: ImpactIndex(graph))
+
+
+def search_index():
+    ''' The search index of the collected graph, rebuilt when collect.py rewrites it '''
+    graph = current_graph()
+    return cached_data(file_version(GRAPH_FILE) + ('search',), lambda: SearchIndex(graph))
+
+
+def request_ids(field):
+    ''' A list of node ids from the JSON request body '''
+    # no body is no ids, but a body has to be a JSON object
+    body = request.get_json(silent=True) if request.get_data() else {}
+    if not isinstance(body, dict):
+        abort(400)
+    ids = body.get(field, [])
+    if not isinstance(ids, list) or not all(isinstance(key, str) for key in ids):
+        abort(400)
+    return ids
+
+
+def get_session(session_id):
+    ''' An open impact session, or a 404 '''
+    with impact_sessions_lock:
+        if session_id not in impact_sessions:
+            abort(404)
+        impact_sessions.move_to_end(session_id)
+        return impact_sessions[session_id]
+
+
+def int_arg(name, default, maximum):
+    ''' A whole number query string argument between 0 and maximum, or a 400 '''
+    value = request.args.get(name, default, type=int)
+    if not 0 <= value <= maximum:
+        abort(400)
+    return value
+
+
+@app.route('/api/neighbourhood')
+def neighbourhood():
+    '''
+    The nodes within a number of hops of a node, or of the nodes matching
+    a search, and the edges between them as Cytoscape elements.
+    Takes node=<id> or q=<text>, hops (default 1), direction of up, down
+    or both (default) and limit on the number of nodes.
+    '''
+    graph = current_graph()
+    hops = int_arg('hops', 1, MAX_HOPS)
+    limit = int_arg('limit', DEFAULT_NEIGHBOURHOOD_LIMIT, MAX_NEIGHBOURHOOD_LIMIT)
+    direction = request.args.get('direction', 'both')
+    if direction not in ('up', 'down', 'both'):
+        abort(400)
+
+    if 'node' in request.args:
+        if request.args['node'] not in graph.index:
+            abort(404)
+        seeds = [graph.index[request.args['node']]]
+    elif request.args.get('q'):
+        seeds = [node for node, _ in search_index().search(request.args['q'], MAX_SEEDS)[0]]
+    else:
+        abort(400)
+
+    nodes, truncated = graph.neighbourhood(seeds[:limit], hops, direction, limit)
+    elements = graph.subgraph_elements(nodes)
+    elements['seeds'] = [graph.ids[node] for node in seeds]
+    elements['truncated'] = truncated
+    return jsonify(elements)
+
+
+@app.route('/api/search')
+def search():
+    '''
+    Ranked search over node names, descriptions, types and regions, for
+    the search box and autocomplete. Takes q=<text>, limit, and optionally
+    type and region to only return nodes of a type or in a region.
+    '''
+    limit = int_arg('limit', DEFAULT_SEARCH_LIMIT, MAX_SEARCH_LIMIT)
+    index = search_index()
+    matches, total = index.search(
+        request.args.get('q', ''), limit, request.args.get('type'), request.args.get('region')
+    )
+    return jsonify(
+        query=request.args.get('q', ''),
+        total=total,
+        results=[
+            {
+                'id': index.graph.ids[node],
+                'name': index.graph.names[node],
+                'type': index.graph.types[node],
+                'region': index.graph.regions[node],
+                'rank': rank,
+            }
+            for node, rank in matches
+        ],
+    )
+
+
+@app.route('/api/impact', methods=['POST'])
+def impact():
+    '''
+    The nodes that depend on any of a set of failed nodes.
+    Takes {"failed": [node id, ...]}.
+    '''
+    return jsonify(impact_index().impact(request_ids('failed')))
+
+
+@app.route('/api/impact/sessions', methods=['POST'])
+def create_impact_session():
+    '''
+    Open a session to fail and restore nodes one at a time, optionally
+    starting with {"failed": [node id, ...]}
+    '''
+    session = ImpactSession(impact_index())
+    result = session.update(add=request_ids('failed'))
+
+    session_id = uuid.uuid4().hex
+    with impact_sessions_lock:
+        impact_sessions[session_id] = session
+        while len(impact_sessions) > MAX_SESSIONS:
+            impact_sessions.popitem(last=False)
+
+    return jsonify(session=session_id, unknown=result['unknown'], **session.state()), 201
+
+
+@app.route('/api/impact/sessions/<session_id>', methods=['GET'])
+def get_impact_session(session_id):
+    ''' The failed and affected nodes of a session '''
+    session = get_session(session_id)
+    with session.lock:
+        return jsonify(session=session_id, **session.state())
+
+
+@app.route('/api/impact/sessions/<session_id>', methods=['PATCH'])
+def update_impact_session(session_id):
+    '''
+    Fail and restore nodes in a session with {"add": [...], "remove": [...]}.
+    Returns just the nodes that became or stopped being affected.
+    '''
+    session = get_session(session_id)
+    add = request_ids('add')
+    remove = request_ids('remove')
+    with session.lock:
+        result = session.update(add=add, remove=remove)
+        result['failed'] = sorted(session.index.graph.ids[node] for node in session.failed)
+        result['count'] = session.affected_count()
+    return jsonify(session=session_id, **result)
+
+
+@app.route('/api/impact/sessions/<session_id>', methods=['DELETE'])
+def delete_impact_session(session_id):
+    ''' Close a session '''
+    with impact_sessions_lock:
+        impact_sessions.pop(session_id, None)
+    return '', 204
+
+
+def parse_args(argv=None):
+    ''' Parse the command line options '''
+    parser = argparse.ArgumentParser(description='Serve the infra-viz frontend and data')
+    parser.add_argument('--host', default=HOST, help='Address to listen on (default: %(default)s)')
+    parser.add_argument('--port', type=int, default=PORT, help='Port to listen on (default: %(default)s)')
+    parser.add_argument(
+        '--production',
+        action='store_true',
+        help='Serve with waitress, without the debugger or reloader'
+    )
+    parser.add_argument(
+        '--threads',
+        type=int,
+        default=8,
+        help='Threads to serve requests with in production mode (default: %(default)s)'
+    )
+    return parser.parse_args(argv)
+
+
 if __name__ == '__main__':
-    app.run(debug=True, host=HOST, port=PORT)
+    args = parse_args()
+    if args.production and waitress is None:
+        sys.exit('--production needs waitress, install it with: pip install waitress')
+    if os.path.isfile(GRAPH_FILE):
+        # build the indexes up front rather than on the first search
+        search_index()
+        impact_index()
+    if not args.production:
+        app.run(debug=True, host=args.host, port=args.port)
+    else:
+        waitress.serve(app, host=args.host, port=args.port, threads=args.threads)
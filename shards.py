@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Cytoscape elements split into shards by region and node type, so the
+viewer can load just the parts of the estate it is looking at.
+
+Each partition's shard holds its nodes and the edges between them. Edges
+from one partition to another are kept in the source partition's cross
+shard. A manifest lists every shard with its counts and size, and for
+cross shards which partitions their edges go to.
+'''
+
+import json
+import logging
+import os
+import re
+import shutil
+
+from graph import save_gzip_json
+
+logger = logging.getLogger('main')
+
+# Bump when the manifest format changes
+shards_version = 1
+
+# Region of nodes that aren't in one, such as route53 and cloudfront
+GLOBAL_REGION = 'global'
+
+
+def partition(graph, node):
+    ''' The (region, type) partition of a node '''
+    return graph.regions[node] or GLOBAL_REGION, graph.types[node]
+
+
+def partition_name(region, node_type):
+    ''' A partition as region/type, which is also its shard's path without the extension '''
+    return '{}/{}'.format(safe_name(region), safe_name(node_type))
+
+
+def safe_name(name):
+    ''' A region or type made safe to use as a file name '''
+    return re.sub(r'[^A-Za-z0-9_.-]', '_', name)
+
+
+def write_shards(graph, directory):
+    '''
+    Write a shard per partition, a cross shard per partition with edges out
+    of it, and the manifest. The new shards replace the old directory in
+    one go so no stale shards are left behind.
+    '''
+    partitions = [partition(graph, node) for node in range(graph.node_count)]
+
+    shards = {}
+    for node in range(graph.node_count):
+        shards.setdefault(partitions[node], {'nodes': [], 'edges': []})['nodes'].append(graph.node_element(node))
+
+    cross = {}
+    for edge in range(graph.edge_count):
+        source = partitions[graph.sources[edge]]
+        target = partitions[graph.targets[edge]]
+        if source == target:
+            shards[source]['edges'].append({'data': graph.edge_data(edge)})
+        else:
+            shard = cross.setdefault(source, {'edges': [], 'targets': {}})
+            shard['edges'].append({'data': graph.edge_data(edge)})
+            name = partition_name(*target)
+            shard['targets'][name] = shard['targets'].get(name, 0) + 1
+
+    tmp_directory = directory + '.tmp'
+    shutil.rmtree(tmp_directory, ignore_errors=True)
+    os.makedirs(tmp_directory)
+
+    manifest = {'version': shards_version, 'shards': [], 'cross': []}
+    for (region, node_type), elements in sorted(shards.items()):
+        filename = partition_name(region, node_type) + '.json.gz'
+        size = save_shard(tmp_directory, filename, elements)
+        manifest['shards'].append({
+            'region': region,
+            'type': node_type,
+            'file': filename,
+            'nodes': len(elements['nodes']),
+            'edges': len(elements['edges']),
+            'bytes': size,
+        })
+
+    for (region, node_type), shard in sorted(cross.items()):
+        filename = 'cross/' + partition_name(region, node_type) + '.json.gz'
+        size = save_shard(tmp_directory, filename, {'nodes': [], 'edges': shard['edges']})
+        manifest['cross'].append({
+            'region': region,
+            'type': node_type,
+            'file': filename,
+            'edges': len(shard['edges']),
+            'bytes': size,
+            'targets': shard['targets'],
+        })
+
+    manifest['regions'] = sorted({region for region, _ in shards})
+    manifest['types'] = sorted({node_type for _, node_type in shards})
+    with open(os.path.join(tmp_directory, 'manifest.json'), 'w') as file:
+        json.dump(manifest, file, indent=1, sort_keys=True)
+
+    old_directory = directory + '.old'
+    shutil.rmtree(old_directory, ignore_errors=True)
+    if os.path.isdir(directory):
+        os.rename(directory, old_directory)
+    os.rename(tmp_directory, directory)
+    shutil.rmtree(old_directory, ignore_errors=True)
+
+    logger.info('shards: %d partitions, %d with cross partition edges',
+                len(manifest['shards']), len(manifest['cross']))
+    return manifest
+
+
+def save_shard(directory, filename, elements):
+    ''' Save a shard's elements, returning the size of the file '''
+    path = os.path.join(directory, filename)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    save_gzip_json(path, elements)
+    return os.path.getsize(path)
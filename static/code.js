@@ -128,7 +128,7 @@ var cy = window.cy = cytoscape({
       }
     },
      {
-      selector: 'edge[weight="0"]',
+      selector: 'edge[weight="0"], edge[weight = 0]',
       css: {
         'line-style': 'dashed',
         'line-color' : 'rgb(255,0,0)',
@@ -168,6 +168,15 @@ var cy = window.cy = cytoscape({
         'background-color' : 'rgb(252,165,0)'
       }
     },
+    {
+      // loaded on demand and with edges still to load, right click for more
+      selector : 'node[more > 0]',
+      css : {
+        'border-style' : 'dashed',
+        'border-width' : '2',
+        'border-color' : 'rgb(100,100,100)'
+      }
+    },
     {
       selector: '.flash',
       css: {
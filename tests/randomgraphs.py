@@ -0,0 +1,56 @@
+'''
+Small random graphs, and brute force answers to check the graph
+algorithms against.
+'''
+
+from graph import Graph
+
+TYPES = ['dns', 'elb', 'ec2', 'rds']
+REGIONS = ['us-east-1', 'eu-west-1', None]
+
+
+def random_graph(rng, nodes, edges, dag=False, names=None):
+    '''
+    A graph of nodes with random types and regions and up to edges random
+    edges. With dag, edges only go from lower to higher node numbers.
+    '''
+    graph = Graph()
+    for node in range(nodes):
+        name = names(rng, node) if names else 'n{}'.format(node)
+        graph.add_node(rng.choice(TYPES), name, 'node {}'.format(node), rng.choice(REGIONS), 1)
+
+    for _ in range(edges):
+        source, target = rng.randrange(graph.node_count), rng.randrange(graph.node_count)
+        if dag:
+            if source == target:
+                continue
+            source, target = min(source, target), max(source, target)
+        graph.sources.append(source)
+        graph.targets.append(target)
+        graph.edge_types.append('depends')
+        graph.edge_weights.append(1)
+        graph.edge_counters.append(1)
+
+    graph.index_edges()
+    return graph
+
+
+def reachable(graph, node, forward=True):
+    '''
+    The nodes and edge numbers reachable from a node through one or more
+    edges, following them forwards or backwards
+    '''
+    nodes = set()
+    edges = set()
+    pending = [node]
+    while pending:
+        current = pending.pop()
+        for edge, (source, target) in enumerate(zip(graph.sources, graph.targets)):
+            if not forward:
+                source, target = target, source
+            if source == current:
+                edges.add(edge)
+                if target not in nodes:
+                    nodes.add(target)
+                    pending.append(target)
+    return nodes, edges
@@ -0,0 +1,75 @@
+'''
+Decoding bulk cache reads on the process pool gives the same results as
+decoding them in process.
+'''
+
+import json
+
+import pytest
+
+import collect
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    ''' Use the process pool for anything over a few items '''
+    monkeypatch.setattr(collect, 'decode_workers', 2)
+    monkeypatch.setattr(collect, 'decode_chunk_size', 3)
+    monkeypatch.setattr(collect, 'decode_min_chunks', 2)
+    yield
+    collect.close_decode_pool()
+
+
+def records(index):
+    return {'Items': [{'Name': 'item-{}-{}'.format(index, n), 'Size': n} for n in range(index % 4)]}
+
+
+def test_read_json_files_in_parallel(tmp_path, pool):
+    filenames = []
+    for index in range(20):
+        filename = tmp_path / '{}.json'.format(index)
+        filename.write_text(json.dumps(records(index)))
+        filenames.append(str(filename))
+    # unreadable and missing files decode to (False, None) either way
+    (tmp_path / 'bad.json').write_text('{not json')
+    filenames[5] = str(tmp_path / 'bad.json')
+    filenames[11] = str(tmp_path / 'missing.json')
+
+    parallel = collect.decode_in_parallel(collect.read_json_files, filenames)
+    assert collect.decode_pool is not None
+    assert parallel == collect.read_json_files(filenames)
+    assert parallel[5] == parallel[11] == (False, None)
+
+
+def test_decode_payloads_in_parallel(pool):
+    payloads = [collect.SqliteCache.encode(records(index)) for index in range(17)]
+
+    parallel = collect.decode_in_parallel(collect.decode_payloads, payloads)
+    assert collect.decode_pool is not None
+    assert parallel == collect.decode_payloads(payloads)
+    assert parallel == [records(index) for index in range(17)]
+
+
+@pytest.mark.parametrize('backend', ['files', 'sqlite'])
+def test_get_many_in_parallel(tmp_path, monkeypatch, backend):
+    monkeypatch.setattr(collect, 'cache_dir', str(tmp_path))
+    store = collect.open_cache(backend)
+    for index in range(25):
+        store.put('s3', 'get_bucket_location', 'us-east-1', 'key{}'.format(index), records(index))
+
+    monkeypatch.setattr(collect, 'decode_workers', 1)
+    serial = store.get_many('s3', 'get_bucket_location', 'us-east-1')
+
+    monkeypatch.setattr(collect, 'decode_workers', 2)
+    monkeypatch.setattr(collect, 'decode_chunk_size', 4)
+    monkeypatch.setattr(collect, 'decode_min_chunks', 2)
+    try:
+        parallel = store.get_many('s3', 'get_bucket_location', 'us-east-1')
+        assert collect.decode_pool is not None
+    finally:
+        collect.close_decode_pool()
+        store.close()
+
+    assert {key: value[1] for key, value in parallel.items()} == \
+        {key: value[1] for key, value in serial.items()} == \
+        {'key{}'.format(index): records(index) for index in range(25)}
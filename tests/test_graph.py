@@ -0,0 +1,56 @@
+'''
+The strongly connected components and transitive counts of graph.py
+against brute force on random graphs.
+'''
+
+import random
+
+import pytest
+
+import graph as graph_module
+from randomgraphs import random_graph, reachable
+
+
+def random_graphs(count=150):
+    rng = random.Random(16)
+    for seed in range(count):
+        nodes = rng.randrange(1, 40)
+        yield random_graph(rng, nodes, rng.randrange(0, 3 * nodes), dag=seed % 2 == 0)
+
+
+def test_strongly_connected_components():
+    for graph in random_graphs():
+        component, components = graph_module.strongly_connected_components(graph)
+        assert sorted(node for members in components for node in members) == list(range(graph.node_count))
+
+        reaches = [reachable(graph, node)[0] | {node} for node in range(graph.node_count)]
+        for first in range(graph.node_count):
+            for second in range(graph.node_count):
+                together = second in reaches[first] and first in reaches[second]
+                assert (component[first] == component[second]) == together
+
+        # everything a component depends on comes before it
+        for source, target in zip(graph.sources, graph.targets):
+            assert component[target] <= component[source]
+
+
+def test_strongly_connected_components_deep_chain():
+    graph = random_graph(random.Random(0), 20000, 0)
+    for node in range(graph.node_count - 1):
+        graph.sources.append(node)
+        graph.targets.append(node + 1)
+    graph.index_edges()
+
+    component, components = graph_module.strongly_connected_components(graph)
+    assert len(components) == graph.node_count
+
+
+@pytest.mark.parametrize('limit', [graph_module.REACH_LIMIT, 12])
+def test_count_reachable(monkeypatch, limit):
+    monkeypatch.setattr(graph_module, 'REACH_LIMIT', limit)
+    for graph in random_graphs():
+        graph.count_reachable()
+        for node in range(graph.node_count):
+            for forward, counts in ((True, graph.successor_counts), (False, graph.predecessor_counts)):
+                nodes, edges = reachable(graph, node, forward)
+                assert counts[node] == min(len(nodes) + len(edges), limit)
@@ -0,0 +1,57 @@
+'''
+Blast radius queries and sessions against brute force on random graphs.
+'''
+
+import random
+
+from impact import ImpactIndex, ImpactSession
+from randomgraphs import random_graph, reachable
+
+
+def upstream(graph, failed):
+    ''' Node ids that depend on any failed node through one or more edges '''
+    affected = set()
+    for node in failed:
+        affected |= reachable(graph, node, forward=False)[0]
+    return sorted(graph.ids[node] for node in affected)
+
+
+def test_impact():
+    rng = random.Random(17)
+    for seed in range(100):
+        nodes = rng.randrange(1, 40)
+        graph = random_graph(rng, nodes, rng.randrange(0, 3 * nodes), dag=seed % 2 == 0)
+        # a tiny closure cache so evictions are exercised too
+        index = ImpactIndex(graph, cache_size=3)
+        for _ in range(5):
+            failed = rng.sample(range(nodes), rng.randrange(0, min(nodes, 4) + 1))
+            result = index.impact([graph.ids[node] for node in failed] + ['missing'])
+            assert result['affected'] == upstream(graph, failed)
+            assert result['count'] == len(result['affected'])
+            assert result['unknown'] == ['missing']
+
+
+def test_session():
+    rng = random.Random(18)
+    for seed in range(60):
+        nodes = rng.randrange(1, 30)
+        graph = random_graph(rng, nodes, rng.randrange(0, 3 * nodes), dag=seed % 2 == 0)
+        session = ImpactSession(ImpactIndex(graph))
+        failed = set()
+        affected = set()
+        for _ in range(10):
+            add = rng.sample(range(nodes), rng.randrange(0, min(nodes, 3) + 1))
+            remove = rng.sample(range(nodes), rng.randrange(0, min(nodes, 3) + 1))
+            change = session.update(add=[graph.ids[node] for node in add],
+                                    remove=[graph.ids[node] for node in remove])
+            failed = (failed | set(add)) - set(remove)
+
+            now = set(upstream(graph, failed))
+            assert set(change['added']) == now - affected
+            assert set(change['removed']) == affected - now
+            affected = now
+
+            state = session.state()
+            assert state['affected'] == sorted(affected)
+            assert state['failed'] == sorted(graph.ids[node] for node in failed)
+            assert session.affected_count() == len(affected)
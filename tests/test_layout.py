@@ -0,0 +1,81 @@
+'''
+Layouts of random graphs, and relayouts after they change: components never
+overlap, and unchanged components keep their positions.
+'''
+
+import random
+
+import layout
+from randomgraphs import random_graph
+
+
+def boxes_overlap(first, second):
+    ''' Whether two boxes are closer than the gap, by comparing every pair '''
+    x, y, width, height = first
+    other_x, other_y, other_width, other_height = second
+    gap = layout.COMPONENT_GAP
+    return (x < other_x + other_width + gap and other_x < x + width + gap and
+            y < other_y + other_height + gap and other_y < y + height + gap)
+
+
+def check_layout(graph, saved):
+    assert all(position is not None for position in graph.positions)
+    boxes = [component['box'] for component in saved['components']]
+    for index, box in enumerate(boxes):
+        for other in boxes[index + 1:]:
+            assert not boxes_overlap(box, other)
+
+    for component in saved['components']:
+        x, y, width, height = component['box']
+        for node_x, node_y in component['positions'].values():
+            assert x <= node_x <= x + width and y <= node_y <= y + height
+
+
+def test_box_index():
+    rng = random.Random(15)
+    for _ in range(100):
+        index = layout.BoxIndex()
+        placed = []
+        for _ in range(40):
+            box = (rng.uniform(-5000, 20000), rng.uniform(-5000, 20000),
+                   rng.choice([0, 80, rng.uniform(0, 9000)]), rng.choice([0, 160, rng.uniform(0, 9000)]))
+            assert index.overlaps(box) == any(boxes_overlap(box, other) for other in placed)
+            index.add(box)
+            placed.append(box)
+
+
+def test_relayout():
+    rng = random.Random(15)
+    for _ in range(20):
+        nodes = rng.randrange(5, 120)
+        graph = random_graph(rng, nodes, rng.randrange(0, nodes))
+        saved = layout.layout_graph(graph)
+        check_layout(graph, saved)
+
+        # the same graph again keeps every position
+        again = random_graph(random.Random(0), 0, 0)
+        again.__dict__.update(graph.__dict__)
+        layout.layout_graph(again, saved)
+        assert again.positions == graph.positions
+
+        # add nodes and edges, joining up some components
+        changed = random_graph(random.Random(0), 0, 0)
+        for node in range(graph.node_count):
+            changed.add_node(graph.types[node], graph.names[node])
+        for node in range(rng.randrange(0, 20)):
+            changed.add_node('dns', 'new{}'.format(node))
+        pairs = list(zip(graph.sources, graph.targets))
+        pairs += [(rng.randrange(changed.node_count), rng.randrange(changed.node_count))
+                  for _ in range(rng.randrange(0, 10))]
+        for source, target in pairs:
+            changed.sources.append(source)
+            changed.targets.append(target)
+        changed.index_edges()
+
+        resaved = layout.layout_graph(changed, saved)
+        check_layout(changed, resaved)
+
+        old_keys = {component['key']: component for component in saved['components']}
+        for component in resaved['components']:
+            if component['key'] in old_keys:
+                assert component['positions'] == old_keys[component['key']]['positions']
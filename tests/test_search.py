@@ -0,0 +1,67 @@
+'''
+The search index against plain substring search on random node names.
+'''
+
+import random
+
+from randomgraphs import random_graph
+from search import EXACT, FIELD, OTHER_SUBSTRING, SUBSTRING, SearchIndex
+
+
+def random_name(rng, node):
+    return ''.join(rng.choice('abcAB.-') for _ in range(rng.randrange(1, 12)))
+
+
+def queries(rng, index):
+    ''' Substrings of the indexed text and random strings, all at least three long '''
+    for _ in range(40):
+        text = rng.choice(index.text)
+        start = rng.randrange(len(text))
+        yield text[start:start + rng.randrange(3, 7)]
+        yield ''.join(rng.choice('abc.-') for _ in range(rng.randrange(3, 6)))
+
+
+def test_substring_search():
+    rng = random.Random(19)
+    for _ in range(30):
+        graph = random_graph(rng, rng.randrange(1, 80), 0, names=random_name)
+        index = SearchIndex(graph)
+        for query in queries(rng, index):
+            query = query.strip()
+            if len(query) < 3 or '\n' in query:
+                continue
+            lower = query.lower()
+            expected = {node for node in range(graph.node_count) if lower in index.text[node]}
+            ranks = index.match(lower, query)
+            assert set(ranks) == expected
+
+            for node, rank in ranks.items():
+                if lower in index.names[node]:
+                    assert rank <= SUBSTRING
+                elif lower in (graph.types[node], graph.regions[node]):
+                    assert rank == FIELD
+                else:
+                    assert rank == OTHER_SUBSTRING
+
+            results, total = index.search(query, limit=graph.node_count)
+            assert total == len(expected)
+            assert {node for node, _ in results} == expected
+            assert [rank for _, rank in results] == sorted(rank for _, rank in results)
+
+
+def test_exact_and_filters():
+    rng = random.Random(20)
+    graph = random_graph(rng, 50, 0, names=random_name)
+    index = SearchIndex(graph)
+    for node in range(graph.node_count):
+        results, _ = index.search(graph.ids[node], limit=graph.node_count)
+        assert (node, EXACT) in results
+
+    for node_type in ('dns', 'elb'):
+        results, total = index.search(node_type, limit=graph.node_count, node_type=node_type, region='eu-west-1')
+        expected = {
+            node for node in range(graph.node_count)
+            if graph.types[node] == node_type and graph.regions[node] == 'eu-west-1'
+        }
+        assert {node for node, _ in results} == expected
+        assert total == len(expected)